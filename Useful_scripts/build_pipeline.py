@@ -0,0 +1,169 @@
+'''
+Build training data from raw definition sources in one command:
+
+    wiktionary: prepare_wiktionary.load_wikt on the enwikt TSV dump
+    merge:      merge_definition_dicts on the Wiktionary output and any
+                other definition dictionaries (e.g. WordNet)
+    preprocess: preprocess_common.main (or main_incremental) producing the
+                training data and dictionary pickles
+
+Each stage is keyed by a content hash of its inputs and parameters,
+recorded in <workdir>/manifest.json, and skipped when its outputs are
+current.
+'''
+import argparse
+import cPickle
+import hashlib
+import json
+import os
+
+import merge_definition_dicts
+import prepare_wiktionary
+import preprocess_common
+
+
+# content hash of a file, memoized in the manifest by (size, mtime)
+def file_hash(path, memo):
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime]
+    if path in memo and memo[path][0] == stamp:
+        return memo[path][1]
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            h.update(block)
+    memo[path] = [stamp, h.hexdigest()]
+    return memo[path][1]
+
+def stage_key(inputs, params, memo):
+    h = hashlib.md5()
+    for path in inputs:
+        h.update(file_hash(os.path.abspath(path), memo))
+    h.update(json.dumps(params, sort_keys=True))
+    return h.hexdigest()
+
+
+class Pipeline(object):
+    '''
+    Runs stages in order, skipping those whose key matches the one stored
+    in the manifest and whose outputs all exist.
+    '''
+    def __init__(self, workdir, force=False):
+        self.workdir = workdir
+        self.force = force
+        self.manifest_file = os.path.join(workdir, 'manifest.json')
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'rb') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'stages': {}, 'files': {}}
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def previous(self, name):
+        return self.manifest['stages'].get(name)
+
+    def run(self, name, inputs, params, outputs, fn):
+        key = stage_key(inputs, params, self.manifest['files'])
+        prev = self.previous(name)
+        if (not self.force and prev is not None and prev['key'] == key
+                and all(os.path.exists(o) for o in outputs)):
+            print '[%s] up to date'%name
+            return False
+        print '[%s] running'%name
+        fn()
+        self.manifest['stages'][name] = {'key': key, 'outputs': outputs}
+        self.save()
+        return True
+
+    def save(self):
+        tmp = self.manifest_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.manifest_file)
+
+
+def build(workdir, embedding_file, output_file, dictionary_file,
+          wiktionary=None, vocab=None, dicts=(), existing_dict=None,
+          max_defs=None, max_wikt_defs=prepare_wiktionary.max_definitions,
+          incremental=False, n_jobs=None, force=False):
+    pipe = Pipeline(workdir, force=force)
+    def_files = list(dicts)
+
+    if wiktionary:
+        wikt_file = pipe.path('wiktionary_defs.pkl')
+        def _wiktionary():
+            vocab_set = None
+            if vocab:
+                with open(vocab) as f:
+                    vocab_set = set(f.read().split())
+            D = prepare_wiktionary.load_wikt(wiktionary, vocab=vocab_set,
+                                             max_def=max_wikt_defs, n_jobs=n_jobs)
+            with open(wikt_file, 'wb') as out:
+                cPickle.dump(D, out, protocol=cPickle.HIGHEST_PROTOCOL)
+        pipe.run('wiktionary', [wiktionary] + ([vocab] if vocab else []),
+                 {'max_def': max_wikt_defs}, [wikt_file], _wiktionary)
+        def_files = [wikt_file] + def_files
+
+    if not def_files:
+        raise ValueError('No definition sources given')
+
+    merged_file = pipe.path('merged.defs')
+    pipe.run('merge', def_files, {}, [merged_file],
+             lambda: merge_definition_dicts.merge_files(def_files, merged_file,
+                                                       stream_output=True))
+
+    keys_file = pipe.path('keys.pkl')
+    outputs = [output_file, dictionary_file, keys_file]
+    prev = pipe.previous('preprocess')
+    can_extend = (incremental and prev is not None and prev['outputs'] == outputs
+                  and all(os.path.exists(o) for o in outputs))
+    def _preprocess():
+        if can_extend:
+            preprocess_common.main_incremental(merged_file, embedding_file, output_file,
+                                               dictionary_file, output_file, dictionary_file,
+                                               keys_file, max_defs=max_defs,
+                                               n_jobs=n_jobs, keys_file=keys_file)
+        else:
+            preprocess_common.main(merged_file, embedding_file, output_file, dictionary_file,
+                                   existing_dict=existing_dict, max_defs=max_defs,
+                                   n_jobs=n_jobs, keys_file=keys_file)
+    pipe.run('preprocess', [merged_file, embedding_file] + ([existing_dict] if existing_dict else []),
+             {'max_defs': max_defs}, outputs, _preprocess)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workdir', type=str, default='pipeline_work',
+                        help='directory for intermediate files and the manifest')
+    parser.add_argument('-e', '--embeddings', type=str, required=True,
+                        help='pickled {word: vector} target embeddings')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='training data pickle to write')
+    parser.add_argument('-di', '--dictionary', type=str, required=True,
+                        help='dictionary pickle to write')
+    parser.add_argument('--wiktionary', type=str, default=None,
+                        help='enwikt definitions TSV dump')
+    parser.add_argument('--vocab', type=str, default=None,
+                        help='whitespace-separated vocabulary restricting Wiktionary headwords')
+    parser.add_argument('--dicts', type=str, nargs='*', default=[],
+                        help='further {word: [definitions]} dictionaries (pickles or definition streams) to merge')
+    parser.add_argument('--existing_dict', type=str, default=None,
+                        help='dictionary to extend with new words')
+    parser.add_argument('--max_defs', type=int, default=None,
+                        help='definitions kept per headword (1 for first definitions only)')
+    parser.add_argument('--max_wikt_defs', type=int, default=prepare_wiktionary.max_definitions)
+    parser.add_argument('--incremental', action='store_true',
+                        help='extend the previous outputs, encoding only added or changed definitions')
+    parser.add_argument('--n_jobs', type=int, default=None)
+    parser.add_argument('-f', '--force', action='store_true', help='rerun every stage')
+    args = parser.parse_args()
+
+    build(args.workdir, args.embeddings, args.output, args.dictionary,
+          wiktionary=args.wiktionary, vocab=args.vocab, dicts=args.dicts,
+          existing_dict=args.existing_dict, max_defs=args.max_defs,
+          max_wikt_defs=args.max_wikt_defs, incremental=args.incremental,
+          n_jobs=args.n_jobs, force=args.force)
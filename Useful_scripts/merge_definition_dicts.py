@@ -1,19 +1,21 @@
-import sys
-import cPickle
-
-dict1 = sys.argv[1]
-dict2 = sys.argv[2]
-dict3 = sys.argv[3]
-outfile = sys.argv[4]
+'''
+Merge any number of {word: [definitions]} dictionaries
 
-with open(dict1) as IN:
-    D1 = cPickle.load(IN)
+    python merge_definition_dicts.py dict1.pkl dict2.pkl ... merged.pkl
 
-with open(dict2) as IN:
-    D2 = cPickle.load(IN)
+Inputs are pickled dicts or definition streams (a sequence of pickled
+(word, definitions) records, as written with --stream). A word takes its
+definitions from the first input it appears in, followed by those of every
+later input under the same key or, failing that, its lower-cased form;
+this is what chaining merge_dicts over the inputs gives. Only one input
+dict and the per-input key offsets are held in memory at a time; with
+--stream the merged dict is never built either.
+'''
+import argparse
+import cPickle
+import os
+import tempfile
 
-with open(dict3) as IN:
-    D3 = cPickle.load(IN)
 
 def merge_dicts(A,B):
     D = {}
@@ -31,9 +33,95 @@ def merge_dicts(A,B):
             D[b1] = b2
     return D
 
+# (word, definitions) pairs of a pickled dict or a definition stream
+def iter_definitions(path):
+    with open(path, 'rb') as f:
+        try:
+            first = cPickle.load(f)
+        except EOFError:
+            return
+        if isinstance(first, dict):
+            for item in first.iteritems():
+                yield item
+            return
+        yield first
+        while True:
+            try:
+                yield cPickle.load(f)
+            except EOFError:
+                return
+
+def load_definitions(path):
+    return dict(iter_definitions(path))
+
+def write_definitions(items, path):
+    with open(path, 'wb') as out:
+        pickler = cPickle.Pickler(out, cPickle.HIGHEST_PROTOCOL)
+        for item in items:
+            pickler.dump(item)
+            # records are independent, don't keep references to them
+            pickler.clear_memo()
+
+# copy an input to a definition stream and index each word's record offset
+def _index_input(path, tmpdir):
+    fd, stream = tempfile.mkstemp(suffix='.defs', dir=tmpdir)
+    offsets = {}
+    with os.fdopen(fd, 'wb') as out:
+        for word, defs in iter_definitions(path):
+            offsets[word] = out.tell()
+            cPickle.dump((word, defs), out, cPickle.HIGHEST_PROTOCOL)
+    return stream, offsets
+
+def merge_files(inputs, outfile, stream_output=False):
+    tmpdir = os.path.dirname(os.path.abspath(outfile))
+    streams = []
+    indexes = []
+    try:
+        for path in inputs:
+            stream, offsets = _index_input(path, tmpdir)
+            streams.append(stream)
+            indexes.append(offsets)
+        handles = [open(s, 'rb') for s in streams]
+
+        def _defs(ii, word):
+            handles[ii].seek(indexes[ii][word])
+            return cPickle.load(handles[ii])[1]
+
+        def _merged():
+            for jj, offsets in enumerate(indexes):
+                for word in offsets:
+                    if any(word in indexes[ii] for ii in xrange(jj)):
+                        continue
+                    folded = word.lower()
+                    defs = list(_defs(jj, word))
+                    for ii in xrange(jj+1, len(indexes)):
+                        if word in indexes[ii]:
+                            defs.extend(_defs(ii, word))
+                        elif folded in indexes[ii]:
+                            defs.extend(_defs(ii, folded))
+                    yield word, defs
+
+        try:
+            if stream_output:
+                write_definitions(_merged(), outfile)
+            else:
+                with open(outfile, 'wb') as out:
+                    cPickle.dump(dict(_merged()), out, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            for f in handles:
+                f.close()
+    finally:
+        for s in streams:
+            os.remove(s)
+
+
 if __name__ == '__main__':
-    M1 = merge_dicts(D1,D2)
-    M2 = merge_dicts(M1,D3)
-    with open(outfile,'w') as out:
-        cPickle.dump(M2,out)        
-            
+    parser = argparse.ArgumentParser()
+    parser.add_argument('inputs', type=str, nargs='+',
+                        help='pickled definition dicts or definition streams, in order')
+    parser.add_argument('outfile', type=str)
+    parser.add_argument('--stream', action='store_true',
+                        help='write a definition stream instead of a single pickled dict')
+    args = parser.parse_args()
+
+    merge_files(args.inputs, args.outfile, stream_output=args.stream)
@@ -1,7 +1,11 @@
 import cPickle
+import collections
+import itertools
 import numpy as np
 import string
 
+from multiprocessing import Pool, cpu_count
+
 '''create training / test data from wiktionary files'''
 # possible exclusions: 
 # if the definition contains the word (as a substring)
@@ -63,36 +67,122 @@ def strip_punct(s):
 	return s.translate(string.maketrans("",""), string.punctuation)
 
 
-def load_wikt(filename, vocab=None, single_words=True, obsoletes=True, excl_word_in_def=False, max_def=max_definitions):
-    D = {}
-    counter = 0
-    inp =  open(filename)
-    for l in inp:
-        if counter % 100 == 0:
-            print '%s word:def pairs processed' % (counter)
-        word = l.split('\t')[1]
-        defn = l.split('\t')[-1]
-        if single_words and ' ' in word.strip():
+# single left-to-right pass over s with a stack of open brackets.
+# Equivalent to unpack_parse + bracket_parse + square_parse: if every '}}'
+# closes a '{{l...' template, those are replaced by their last '|' field
+# (other '{{' are kept), else if '{{' and '}}' are balanced they are removed; then, if
+# '[[' and ']]' are balanced, links are replaced by their first field.
+def strip_markup(s):
+    n_l = s.count('{{l')
+    n_open = s.count('{{')
+    n_close = s.count('}}')
+    if n_l > 0 and n_l == n_close:
+        s = _stack_strip(s, '{{l', '}}', _last_field)
+    elif n_open > 0 and n_open == n_close:
+        s = _stack_strip(s, '{{', '}}', lambda content: '')
+    if s.count('[[') > 0 and s.count('[[') == s.count(']]'):
+        s = _stack_strip(s, '[[', ']]', _first_field)
+    return s
+
+def _last_field(content):
+    p = content.rfind('|')
+    return content[p+1:] if p > -1 else ''
+
+def _first_field(content):
+    p = content.find('|')
+    return content[:p] if p > -1 else content
+
+def _stack_strip(s, open_bracket, close_bracket, replace):
+    out = []
+    stack = []
+    ii = 0
+    n = len(s)
+    while ii < n:
+        if s.startswith(open_bracket, ii):
+            stack.append(len(out))
+            out.append(open_bracket)
+            ii += len(open_bracket)
+        elif s.startswith(close_bracket, ii) and stack:
+            start = stack.pop()
+            content = ''.join(out[start+1:])
+            del out[start:]
+            out.append(replace(content))
+            ii += len(close_bracket)
+        else:
+            out.append(s[ii])
+            ii += 1
+    return ''.join(out)
+
+
+# worker state, set once per process by _init_worker
+_filters = {}
+
+def _init_worker(vocab, single_words, obsoletes, excl_word_in_def):
+    _filters.update(vocab=vocab, single_words=single_words,
+                    obsoletes=obsoletes, excl_word_in_def=excl_word_in_def)
+
+# clean a chunk of TSV lines into (word, definition) pairs
+def _clean_lines(lines):
+    vocab = _filters['vocab']
+    pairs = []
+    for l in lines:
+        fields = l.split('\t')
+        word = fields[1]
+        defn = fields[-1]
+        if _filters['single_words'] and ' ' in word.strip():
             continue
         if vocab and not (word in vocab or word.lower() in vocab):
             continue
-        if obsoletes and 'obsolete' in defn:
+        if _filters['obsoletes'] and 'obsolete' in defn:
             continue
-        if excl_word_in_def and word in defn:
+        if _filters['excl_word_in_def'] and word in defn:
             continue
-        defn_c1 = unpack_parse(defn)
-        defn_c2 = bracket_parse(defn_c1)
-        defn_c3 = square_parse(defn_c2)
-        defn_c4 = strip_punct(defn_c3)
-        defn_c5 = defn_c4.strip()
-        if word in D and len(D[word]) > max_def:
-            continue
-        elif word in D and len(defn_c5) > 1:
-            D[word].append(defn_c5)
-        elif len(defn_c5) > 1:
-            D[word] = [defn_c5]
-            counter +=1
-    inp.close()
+        pairs.append((word, strip_punct(strip_markup(defn)).strip()))
+    return pairs
+
+def _chunks(inp, chunk_size):
+    while True:
+        chunk = list(itertools.islice(inp, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def load_wikt(filename, vocab=None, single_words=True, obsoletes=True, excl_word_in_def=False, 
+              max_def=max_definitions, n_jobs=None, chunk_size=10000, progress_every=100000):
+    D = {}
+    counter = 0
+    n_jobs = n_jobs or cpu_count()
+    pool = Pool(n_jobs, initializer=_init_worker, 
+                initargs=(vocab, single_words, obsoletes, excl_word_in_def))
+    pending = collections.deque()
+
+    def _merge(pairs):
+        n_added = 0
+        for word, defn in pairs:
+            if word in D and len(D[word]) > max_def:
+                continue
+            elif word in D and len(defn) > 1:
+                D[word].append(defn)
+            elif len(defn) > 1:
+                D[word] = [defn]
+                n_added += 1
+        return n_added
+
+    try:
+        with open(filename) as inp:
+            # keep a bounded number of chunks in flight, merged in file order
+            for chunk in _chunks(inp, chunk_size):
+                pending.append(pool.apply_async(_clean_lines, (chunk,)))
+                if len(pending) >= 2 * n_jobs:
+                    n_before = counter
+                    counter += _merge(pending.popleft().get())
+                    if counter / progress_every > n_before / progress_every:
+                        print '%s word:def pairs processed' % (counter)
+            while pending:
+                counter += _merge(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
     return D
 
 
@@ -0,0 +1,189 @@
+'''
+Shared single-pass, multi-process definition preprocessing used by
+preprocess_alldefs.py and preprocess_firstdef.py
+'''
+import cPickle as pkl
+import numpy
+
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from nltk.tokenize import wordpunct_tokenize
+
+from merge_definition_dicts import load_definitions
+
+
+# worker: tokenize a chunk of definitions and count its words
+def _tokenize_chunk(chunk):
+    counts = OrderedDict()
+    tokens = []
+    for dd in chunk:
+        words = wordpunct_tokenize(dd.strip())
+        for ww in words:
+            if ww not in counts:
+                counts[ww] = 1
+            else:
+                counts[ww] += 1
+        tokens.append(words)
+    return counts, tokens
+
+# (headword, vector, definition) for every definition whose headword has
+# an embedding
+def iter_defs(wn_defs, w2v, max_defs=None):
+    for kk, vv in wn_defs.iteritems():
+        if kk in w2v:
+            vec = w2v[kk]
+        elif kk.lower() in w2v:
+            vec = w2v[kk.lower()]
+        else:
+            continue
+        for dd in vv[:max_defs]:
+            yield kk, vec, dd
+
+# select the (vector, definitions) pairs whose headword has an embedding
+def select_defs(wn_defs, w2v, max_defs=None):
+    vecs = []
+    defs = []
+    for kk, vec, dd in iter_defs(wn_defs, w2v, max_defs):
+        vecs.append(vec)
+        defs.append(dd)
+    return vecs, defs
+
+# tokenize all definitions once, in a process pool over chunks; returns the
+# merged word counts (in order of first appearance) and the token lists
+def tokenize_defs(defs, n_jobs=None, chunk_size=10000, progress_every=100000):
+    chunks = [defs[ii:ii+chunk_size] for ii in xrange(0, len(defs), chunk_size)]
+    wordcounts = OrderedDict()
+    tokens = []
+    pool = Pool(n_jobs or cpu_count())
+    try:
+        # imap keeps chunk order, so first-appearance order matches a serial pass
+        for counts, chunk_tokens in pool.imap(_tokenize_chunk, chunks):
+            for ww, cc in counts.iteritems():
+                if ww not in wordcounts:
+                    wordcounts[ww] = cc
+                else:
+                    wordcounts[ww] += cc
+            n_before = len(tokens)
+            tokens.extend(chunk_tokens)
+            if len(tokens) / progress_every > n_before / progress_every:
+                print len(tokens),'/',len(defs),'tokenized'
+    finally:
+        pool.close()
+        pool.join()
+    return wordcounts, tokens
+
+# words sorted by decreasing frequency get ids from 2 (0: <eos>, 1: UNK);
+# with an existing dictionary only new words are appended
+def build_worddict(wordcounts, existing_dict=None):
+    words = wordcounts.keys()
+    counts = wordcounts.values()
+
+    sorted_idx = numpy.argsort(counts)
+
+    if existing_dict:
+        with open(existing_dict, 'rb') as inp:
+            worddict = pkl.load(inp)
+        maxval = max(worddict.values())
+        counter = 0
+        for sidx in sorted_idx[::-1]:
+            if not words[sidx] in worddict:
+                counter += 1
+                worddict[words[sidx]] = maxval + counter
+    else:
+        worddict = OrderedDict()
+        for idx, sidx in enumerate(sorted_idx[::-1]):
+            worddict[words[sidx]] = idx+2
+    return worddict
+
+def _load_inputs(input_file, embedding_file):
+    wn_defs = load_definitions(input_file)
+
+    print 'Loading w2v...',
+    with open(embedding_file, 'rb') as f:
+        w2v = pkl.load(f)
+    print 'Done'
+    return wn_defs, w2v
+
+def _save(output_file, x, y, keys_file=None, keys=None):
+    print 'Saving...',
+    with open(output_file, 'wb') as f:
+        pkl.dump(x,f)
+        pkl.dump(y,f)
+    # (headword, definition) of every row, used by main_incremental
+    if keys_file:
+        with open(keys_file, 'wb') as f:
+            pkl.dump(keys, f, protocol=pkl.HIGHEST_PROTOCOL)
+    print 'Done'
+
+def main(input_file, embedding_file, output_file, dictionary_file,
+         existing_dict=None, max_defs=None, n_jobs=None, keys_file=None):
+    wn_defs, w2v = _load_inputs(input_file, embedding_file)
+
+    selected = list(iter_defs(wn_defs, w2v, max_defs=max_defs))
+    del w2v
+    keys = [(kk, dd) for kk, vec, dd in selected]
+    x = [vec for kk, vec, dd in selected]
+    defs = [dd for kk, vec, dd in selected]
+    del selected
+
+    print 'Tokenizing %d definitions...'%len(defs)
+    wordcounts, tokens = tokenize_defs(defs, n_jobs=n_jobs)
+    print 'Done'
+
+    print 'Building a dictionary...',
+    worddict = build_worddict(wordcounts, existing_dict)
+    with open(dictionary_file, 'wb') as f:
+        pkl.dump(worddict, f)
+    print 'Done'
+
+    print 'Encoding...',
+    y = [[worddict[w] for w in words] for words in tokens]
+    print 'Done'
+
+    _save(output_file, x, y, keys_file, keys)
+
+# re-encode a changed definitions file against a previous run of main():
+# rows whose (headword, definition) is unchanged keep their encoding, only
+# added or changed definitions are tokenized, and their new words are
+# appended to the previous dictionary (as with existing_dict), so earlier
+# word ids stay valid
+def main_incremental(input_file, embedding_file, output_file, dictionary_file,
+                     prev_output, prev_dictionary, prev_keys, max_defs=None,
+                     n_jobs=None, keys_file=None):
+    with open(prev_output, 'rb') as f:
+        pkl.load(f)
+        prev_y = pkl.load(f)
+    with open(prev_keys, 'rb') as f:
+        prev_keys = pkl.load(f)
+    encoded = dict(zip(prev_keys, prev_y))
+    del prev_y, prev_keys
+
+    wn_defs, w2v = _load_inputs(input_file, embedding_file)
+
+    x = []
+    y = []
+    keys = []
+    new_rows = []
+    new_defs = []
+    for kk, vec, dd in iter_defs(wn_defs, w2v, max_defs=max_defs):
+        if (kk, dd) not in encoded:
+            new_rows.append(len(y))
+            new_defs.append(dd)
+        x.append(vec)
+        y.append(encoded.get((kk, dd)))
+        keys.append((kk, dd))
+    del w2v, encoded
+    print '%d of %d definitions are new or changed'%(len(new_defs), len(keys))
+
+    wordcounts, tokens = tokenize_defs(new_defs, n_jobs=n_jobs)
+
+    print 'Extending the dictionary...',
+    worddict = build_worddict(wordcounts, prev_dictionary)
+    with open(dictionary_file, 'wb') as f:
+        pkl.dump(worddict, f)
+    print 'Done'
+
+    for ii, words in zip(new_rows, tokens):
+        y[ii] = [worddict[w] for w in words]
+
+    _save(output_file, x, y, keys_file, keys)
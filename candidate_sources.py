@@ -0,0 +1,152 @@
+'''
+Pluggable candidate sources for the reverse dictionary, queried concurrently
+'''
+import json
+import sys
+import time
+import urllib
+import urllib2
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+class CandidateSource(object):
+    '''
+    A named provider of candidate words for a description.
+
+    Subclasses implement fetch(query) and return a list of words, best
+    first. timeout is the number of seconds gather() waits for the source.
+    '''
+    name = 'source'
+    timeout = None
+
+    def fetch(self, query):
+        raise NotImplementedError()
+
+
+class FunctionSource(CandidateSource):
+    '''Wraps a local callable, e.g. the RNN or additive w2v ranking.'''
+    def __init__(self, name, fn, timeout=None):
+        self.name = name
+        self.fn = fn
+        self.timeout = timeout
+
+    def fetch(self, query):
+        return self.fn(query)
+
+
+class DatamuseSource(CandidateSource):
+    '''Reverse-dictionary lookup through the Datamuse (OneLook) API.'''
+    url = 'http://api.datamuse.com/words'
+
+    def __init__(self, name='OneLook', max_results=1000, timeout=2.):
+        self.name = name
+        self.max_results = max_results
+        self.timeout = timeout
+
+    def fetch(self, query):
+        params = urllib.urlencode([('max', self.max_results), ('rd', query.strip())])
+        ret = urllib2.urlopen('%s?%s'%(self.url, params), timeout=self.timeout).read()
+        return [s['word'] for s in json.loads(ret)]
+
+
+class StubSource(CandidateSource):
+    '''
+    Offline stand-in for an external source: answers from a local
+    {query: [words]} table (optionally loaded from a JSON file) after an
+    artificial delay, so the concurrent path can be tested and benchmarked.
+    '''
+    def __init__(self, name='stub', table=None, delay=0., timeout=2.):
+        if isinstance(table, basestring):
+            with open(table, 'rb') as f:
+                table = json.load(f)
+        self.name = name
+        self.table = table or {}
+        self.delay = delay
+        self.timeout = timeout
+
+    def fetch(self, query):
+        if self.delay > 0:
+            time.sleep(self.delay)
+        return list(self.table.get(query.strip(), []))
+
+
+class CachedSource(CandidateSource):
+    '''
+    Answers from a LookupCache when possible, otherwise asks `source`.
+    Cache errors (locked or corrupt database, ...) fall through to `source`.
+    '''
+    def __init__(self, source, cache):
+        self.source = source
+        self.cache = cache
+        self.name = source.name
+        self.timeout = source.timeout
+
+    def fetch(self, query):
+        key = '%s\t%s'%(self.source.name, query)
+        try:
+            candidates = self.cache.get(key)
+        except Exception as e:
+            print >>sys.stderr, 'lookup cache unavailable: %s'%repr(e)
+            candidates = None
+        if candidates is None:
+            candidates = self.source.fetch(query)
+            try:
+                self.cache.put(key, candidates)
+            except Exception as e:
+                print >>sys.stderr, 'lookup cache unavailable: %s'%repr(e)
+        return candidates
+
+
+_pool = None
+_pool_size = 0
+# tasks that missed their timeout and may still occupy a worker thread
+_stalled = []
+
+def _get_pool(n_workers):
+    global _pool, _pool_size
+    _stalled[:] = [res for res in _stalled if not res.ready()]
+    n_workers += len(_stalled)
+    if _pool is None or _pool_size < n_workers:
+        # the old workers exit once their (possibly stalled) tasks are done
+        if _pool is not None:
+            _pool.close()
+        _pool_size = max(n_workers, 4)
+        _pool = ThreadPool(_pool_size)
+    return _pool
+
+# query all sources at once; a source that fails or misses its timeout
+# maps to None so the caller can still use the partial results
+def gather(sources, query, verbose=False):
+    pool = _get_pool(len(sources))
+    start = time.time()
+    pending = [(src, pool.apply_async(src.fetch, (query,))) for src in sources]
+    results = OrderedDict()
+    for src, res in pending:
+        timeout = None
+        if src.timeout is not None:
+            timeout = max(0., src.timeout - (time.time() - start))
+        try:
+            results[src.name] = res.get(timeout)
+        except Exception as e:
+            if verbose:
+                print '%s unavailable: %s'%(src.name, repr(e))
+            results[src.name] = None
+            if not res.ready():
+                _stalled.append(res)
+    return results
+
+# build the external sources selected on the command line
+def external_sources(names, timeout=2., stub_table=None, stub_delay=0., cache=None):
+    sources = []
+    for name in names:
+        if name == 'datamuse':
+            sources.append(DatamuseSource(timeout=timeout))
+        elif name == 'stub':
+            sources.append(StubSource(table=stub_table, delay=stub_delay, timeout=timeout))
+        elif name != 'none':
+            raise ValueError('Unknown candidate source %s'%name)
+    if cache is not None:
+        sources = [CachedSource(src, cache) for src in sources]
+    return sources
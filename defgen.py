@@ -240,9 +240,11 @@ def param_init_lstm_cond(options, params, prefix='lstm_cond', nin=None, dim=None
 def lstm_cond_layer(tparams, state_below, options, prefix='lstm', 
                     mask=None, context=None, one_step=False, 
                     init_memory=None, init_state=None, 
-                    **kwargs):
+                    pctx=None, **kwargs):
 
-    assert context, 'Context must be provided'
+    # pctx: context already projected by Wc, e.g. computed once per sequence
+    if pctx == None:
+        assert context, 'Context must be provided'
 
     if one_step:
         assert init_memory, 'previous memory must be provided'
@@ -268,7 +270,10 @@ def lstm_cond_layer(tparams, state_below, options, prefix='lstm',
         init_memory = tensor.alloc(0., n_samples, dim)
 
     # projected context 
-    pctx_ = tensor.dot(context, tparams[_p(prefix,'Wc')])
+    if pctx == None:
+        pctx_ = tensor.dot(context, tparams[_p(prefix,'Wc')])
+    else:
+        pctx_ = pctx
 
     # projected x
     state_below = tensor.dot(state_below, tparams[_p(prefix, 'W')]) + tparams[_p(prefix, 'b')]
@@ -309,8 +314,38 @@ def lstm_cond_layer(tparams, state_below, options, prefix='lstm',
     return rval
 
 
+# sampled softmax: the cost of y under a softmax over y and n_sampled
+# words drawn from a log-uniform (Zipfian) proposal over the word ids,
+# which the dictionary orders by decreasing frequency. Logits are corrected
+# by the log expected count of each word, and sampled words equal to the
+# target are dropped.
+def sampled_softmax_cost(tparams, state_below, y, options, n_sampled, trng, prefix='ff_logit'):
+    n_words = options['n_words']
+    log_range = numpy.log(n_words + 1.)
+
+    u = trng.uniform((n_sampled,), dtype='float32')
+    sampled = tensor.cast(tensor.floor(tensor.exp(u * log_range)) - 1., 'int64')
+    sampled = tensor.clip(sampled, 0, n_words - 1)
+
+    def _log_count(ids):
+        ids = tensor.cast(ids, 'float32')
+        return tensor.log(n_sampled * tensor.log((ids + 2.) / (ids + 1.)) / log_range)
+
+    W = tparams[_p(prefix, 'W')]
+    b = tparams[_p(prefix, 'b')]
+    true_logit = (state_below * W.T[y]).sum(1) + b[y] - _log_count(y)
+    sampled_logit = tensor.dot(state_below, W[:,sampled]) + b[sampled] - _log_count(sampled)[None,:]
+    sampled_logit = tensor.switch(tensor.eq(y[:,None], sampled[None,:]), -1e8, sampled_logit)
+
+    logits = tensor.concatenate([true_logit[:,None], sampled_logit], axis=1)
+    logit_max = logits.max(axis=1)
+    log_z = tensor.log(tensor.exp(logits - logit_max[:,None]).sum(axis=1)) + logit_max
+    return log_z - true_logit
+
 # build a training model
-def build_model(tparams, options, test=True):
+# n_sampled > 0 replaces the full softmax of the cost by a sampled softmax
+# (for training only: the cost is then a stochastic approximation)
+def build_model(tparams, options, test=True, n_sampled=0):
     trng = RandomStreams(1234)
     use_noise = theano.shared(numpy.float32(0.))
 
@@ -349,15 +384,19 @@ def build_model(tparams, options, test=True):
     logit_ctx = get_layer('ff')[1](tparams, ctx_p, options, prefix='ff_logit_ctx', activ='linear')
     logit_prev = get_layer('ff')[1](tparams, emb, options, prefix='ff_logit_prev', activ='linear')
     logit = tensor.tanh(logit_lstm + logit_ctx[None,:,:] + logit_prev)
-    logit = get_layer('ff')[1](tparams, logit, options, prefix='ff_logit', activ='linear')
-    logit_shp = logit.shape
-    probs = _softmax(logit.reshape([logit_shp[0]*logit_shp[1], logit_shp[2]]))
-    # cost
     x_flat = x.flatten()
-    if test:
-        cost = -tensor.log(probs[tensor.arange(x_flat.shape[0]), x_flat])
+    if n_sampled > 0:
+        logit = logit.reshape([n_timesteps*n_samples, options['dim_word']])
+        cost = sampled_softmax_cost(tparams, logit, x_flat, options, n_sampled, trng)
     else:
-        cost = -tensor.log(probs[tensor.arange(x_flat.shape[0]), x_flat]+1e-8)
+        logit = get_layer('ff')[1](tparams, logit, options, prefix='ff_logit', activ='linear')
+        logit_shp = logit.shape
+        probs = _softmax(logit.reshape([logit_shp[0]*logit_shp[1], logit_shp[2]]))
+        # cost
+        if test:
+            cost = -tensor.log(probs[tensor.arange(x_flat.shape[0]), x_flat])
+        else:
+            cost = -tensor.log(probs[tensor.arange(x_flat.shape[0]), x_flat]+1e-8)
     cost = cost.reshape([x.shape[0], x.shape[1]])
     cost = (cost * mask).sum(0)
     #cost = cost.mean()
@@ -365,8 +404,13 @@ def build_model(tparams, options, test=True):
     return trng, use_noise, x, mask, ctx, cost
 
 # build a sampler
-def build_sampler(tparams, options, trng):
-    # context: 1 x dim
+# f_init computes the context-dependent terms (initial state/memory, the
+# context projected into the decoder and ff_logit_ctx) once per context;
+# f_next takes them as inputs, one row per hypothesis
+# with shortlist=True, f_next takes a last input listing the word ids the
+# output layer is restricted to; next_probs are then over those ids
+def build_sampler(tparams, options, trng, shortlist=False):
+    # context: #contexts x dim
     ctx = tensor.matrix('ctx_sampler', dtype='float32')
     ctx_p = ctx
     if options['n_layers'] > 1:
@@ -377,38 +421,49 @@ def build_sampler(tparams, options, trng):
     # initial state/cell
     init_state = get_layer('ff')[1](tparams, ctx_p, options, prefix='ff_state', activ='tanh')
     init_memory = get_layer('ff')[1](tparams, ctx_p, options, prefix='ff_memory', activ='tanh')
+    # per-context terms of the decoder and the logit
+    pctx = tensor.dot(ctx_p, tparams[_p('decoder', 'Wc')])
+    logit_ctx = get_layer('ff')[1](tparams, ctx_p, options, prefix='ff_logit_ctx', activ='linear')
 
     print 'Building f_init...',
-    f_init = theano.function([ctx], [init_state, init_memory], name='f_init')
+    f_init = theano.function([ctx], [init_state, init_memory, pctx, logit_ctx], name='f_init')
     print 'Done'
 
     # x: 1 x 1
     x = tensor.vector('x_sampler', dtype='int64')
     init_state = tensor.matrix('init_state', dtype='float32')
     init_memory = tensor.matrix('init_memory', dtype='float32')
+    pctx = tensor.matrix('pctx_sampler', dtype='float32')
+    logit_ctx = tensor.matrix('logit_ctx_sampler', dtype='float32')
 
     # if it's the first word, emb should be all zero
     emb = tensor.switch(x[:,None] < 0, tensor.alloc(0., x.shape[0], tparams['Wemb'].shape[1]), 
                         tparams['Wemb'][x])
-    # context project
     proj = get_layer('lstm_cond')[1](tparams, emb, options, 
                                      prefix='decoder', 
-                                     mask=None, context=ctx_p, 
+                                     mask=None, pctx=pctx, 
                                      one_step=True, 
                                      init_state=init_state,
                                      init_memory=init_memory)
     next_state, next_memory = proj[0], proj[1]
 
     logit_lstm = get_layer('ff')[1](tparams, next_state, options, prefix='ff_logit_lstm', activ='linear')
-    logit_ctx = get_layer('ff')[1](tparams, ctx_p, options, prefix='ff_logit_ctx', activ='linear')
     logit_prev = get_layer('ff')[1](tparams, emb, options, prefix='ff_logit_prev', activ='linear')
     logit = tensor.tanh(logit_lstm + logit_ctx + logit_prev)
-    logit = get_layer('ff')[1](tparams, logit, options, prefix='ff_logit', activ='linear')
+    inps = [x, pctx, logit_ctx, init_state, init_memory]
+    if shortlist:
+        words = tensor.vector('shortlist', dtype='int64')
+        logit = tensor.dot(logit, tparams['ff_logit_W'][:,words]) + tparams['ff_logit_b'][words]
+        inps.append(words)
+    else:
+        logit = get_layer('ff')[1](tparams, logit, options, prefix='ff_logit', activ='linear')
     next_probs = tensor.nnet.softmax(logit)
     next_sample = trng.multinomial(pvals=next_probs).argmax(1)
+    if shortlist:
+        next_sample = words[next_sample]
 
     # next word probability
-    f_next = theano.function([x, ctx, init_state, init_memory], [next_probs, next_sample, next_state, next_memory], name='f_next')
+    f_next = theano.function(inps, [next_probs, next_sample, next_state, next_memory], name='f_next')
 
     return f_init, f_next
 
@@ -429,11 +484,29 @@ def build_hess_p(x, mask, ctx, cost):
 
     return f_ctx_hess_p
 
+# initial contexts for reverse inference from a trained defgen_rev
+# encoder (f_prop from defgen_rev.build_fprop, same dictionary): its
+# predicted word vectors, normalized like the training targets
+def warm_start_ctx(f_prop, seqs, batch_size=128):
+    ctx = []
+    for ii in xrange(0, len(seqs), batch_size):
+        x, mask, _ = load_prepare_data.prepare_data(seqs[ii:ii+batch_size], None)
+        ctx.append(f_prop(x, mask))
+    ctx = numpy.concatenate(ctx, axis=0).astype('float32')
+    return ctx / numpy.sqrt((ctx ** 2).sum(1))[:,None]
+
 # infer the word vector given a definition
-def infer_ctx(options, seq, f_cost, f_ctx_grad, init_ctx = None, f_hess_p = None, maxiter=100):
-    if init_ctx == None:
-        init_ctx = 1e-3 * numpy.random.randn(1, options['ctx_dim']).astype('float32')
-    x, mask, ctx0 = prepare_data([seq], init_ctx)
+# f_prop: warm-start from the defgen_rev encoder (see warm_start_ctx)
+# full_output: also return the final cost and the number of gradient
+# evaluations
+def infer_ctx(options, seq, f_cost, f_ctx_grad, init_ctx = None, f_hess_p = None, maxiter=100,
+              f_prop=None, full_output=False):
+    if init_ctx is None:
+        if f_prop is not None:
+            init_ctx = warm_start_ctx(f_prop, [seq])
+        else:
+            init_ctx = 1e-3 * numpy.random.randn(1, options['ctx_dim']).astype('float32')
+    x, mask, ctx0 = load_prepare_data.prepare_data([seq], init_ctx)
 
     def _g(ctx):
         return f_ctx_grad(x, mask, ctx.reshape([1, ctx.shape[0]]).astype('float32')).reshape([ctx.shape[0]])
@@ -449,19 +522,160 @@ def infer_ctx(options, seq, f_cost, f_ctx_grad, init_ctx = None, f_hess_p = None
         print 'Current cost: ', cc
 
     if f_hess_p:
-        ctx_opt = optimize.fmin_ncg(_c, ctx0[0,:], fprime=_g, fhess_p=_hp, callback=None, maxiter=maxiter)
+        ctx_opt, cost, _, n_grads, _, _ = optimize.fmin_ncg(_c, ctx0[0,:], fprime=_g, fhess_p=_hp, callback=None, 
+                                                            maxiter=maxiter, full_output=True)
     else:
-        ctx_opt = optimize.fmin_bfgs(_c, ctx0[0,:], fprime=_g, callback=None, maxiter=maxiter)
+        ctx_opt, cost, _, _, _, n_grads, _ = optimize.fmin_bfgs(_c, ctx0[0,:], fprime=_g, callback=None, 
+                                                                maxiter=maxiter, full_output=True)
 
+    if full_output:
+        return ctx_opt, cost, n_grads
     return ctx_opt
 
+# compare cold-start and warm-start (warm_start_ctx) reverse inference of
+# the same definitions with infer_ctx_batch: iterations and final costs
+def warm_start_report(options, seqs, f_cost_grad, f_prop, seed=1234, **kwargs):
+    rng = numpy.random.RandomState(seed)
+    cold_init = 1e-3 * rng.randn(len(seqs), options['ctx_dim']).astype('float32')
+    warm_init = warm_start_ctx(f_prop, seqs)
+
+    cold_ctx, cold_cost, cold_iters = infer_ctx_batch(options, seqs, f_cost_grad, init_ctx=cold_init, **kwargs)
+    warm_ctx, warm_cost, warm_iters = infer_ctx_batch(options, seqs, f_cost_grad, init_ctx=warm_init, **kwargs)
+
+    print 'Cold start: %.1f iterations, final cost %f'%(cold_iters.mean(), cold_cost.mean())
+    print 'Warm start: %.1f iterations, final cost %f'%(warm_iters.mean(), warm_cost.mean())
+    print 'Iterations saved: %.1f per definition (%.1f%%)'%(
+        cold_iters.mean() - warm_iters.mean(), 
+        100. * (1. - warm_iters.sum() / float(max(cold_iters.sum(), 1))))
+
+    return warm_ctx, {'cold_iters': cold_iters, 'cold_cost': cold_cost, 
+                      'warm_iters': warm_iters, 'warm_cost': warm_cost}
+
+# per-sample cost (a vector, e.g. the cost of build_model before .mean())
+# and its gradient w.r.t. ctx in one call: samples are independent, so row
+# i of the gradient of cost.sum() is the gradient of cost[i]
+def build_batch_reverser(x, mask, ctx, cost):
+    ctx_grad = tensor.grad(cost.sum(), wrt=ctx)
+    f_cost_grad = theano.function([x, mask, ctx], [cost, ctx_grad])
+
+    return f_cost_grad
+
+# Adam on the contexts of one padded minibatch; a sample stops being
+# updated (and is dropped from the minibatch) once its gradient norm falls
+# below tol or its cost has changed by less than tol (relative) for
+# `patience` consecutive iterations
+def _infer_ctx_minibatch(seqs, ctx, f_cost_grad, maxiter=1000, lrate=0.5, tol=3e-6, patience=10,
+                         b1=0.9, b2=0.999, e=1e-8):
+    x, mask, _ = load_prepare_data.prepare_data(seqs, ctx)
+    lengths = mask.sum(0).astype('int64')
+    n_samples = ctx.shape[0]
+
+    ctx = ctx.astype('float32')
+    best_ctx = ctx.copy()
+    best_cost = numpy.inf * numpy.ones(n_samples, dtype='float32')
+    prev_cost = numpy.inf * numpy.ones(n_samples, dtype='float32')
+    n_stalled = numpy.zeros(n_samples, dtype='int64')
+    m = numpy.zeros_like(ctx)
+    v = numpy.zeros_like(ctx)
+    n_iters = numpy.zeros(n_samples, dtype='int64')
+    active = numpy.arange(n_samples)
+
+    for ii in xrange(maxiter + 1):
+        n_steps = lengths[active].max()
+        cost, grad = f_cost_grad(x[:n_steps, active], mask[:n_steps, active], ctx[active])
+
+        improved = cost < best_cost[active]
+        best_cost[active[improved]] = cost[improved]
+        best_ctx[active[improved]] = ctx[active[improved]]
+
+        stalled = numpy.abs(prev_cost[active] - cost) <= tol * numpy.maximum(1., numpy.abs(cost))
+        n_stalled[active] = numpy.where(stalled, n_stalled[active] + 1, 0)
+        converged = (n_stalled[active] >= patience) | (numpy.sqrt((grad ** 2).sum(1)) < tol)
+        prev_cost[active] = cost
+        if ii == maxiter:
+            break
+        keep = ~converged
+        active, grad = active[keep], grad[keep]
+        if active.shape[0] == 0:
+            break
+
+        n_iters[active] += 1
+        t = ii + 1.
+        m[active] = b1 * m[active] + (1. - b1) * grad
+        v[active] = b2 * v[active] + (1. - b2) * grad ** 2
+        step = lrate * numpy.sqrt(1. - b2 ** t) / (1. - b1 ** t)
+        ctx[active] -= (step * m[active] / (numpy.sqrt(v[active]) + e)).astype('float32')
+
+    return best_ctx, best_cost, n_iters
+
+_infer_job = {}
+
+def _infer_ctx_job(job):
+    seqs, ctx = job
+    return _infer_ctx_minibatch(seqs, ctx, _infer_job['f_cost_grad'], **_infer_job['kwargs'])
+
+# infer the word vectors of many definitions at once: definitions are
+# sorted by length and optimized in padded minibatches (see
+# _infer_ctx_minibatch); n_jobs > 1 forks worker processes that share the
+# compiled f_cost_grad from build_batch_reverser
+# returns the contexts, their final costs and the iterations each took
+def infer_ctx_batch(options, seqs, f_cost_grad, init_ctx=None, batch_size=64,
+                    maxiter=1000, lrate=0.5, tol=3e-6, patience=10, n_jobs=1, verbose=False):
+    n_samples = len(seqs)
+    if init_ctx is None:
+        init_ctx = 1e-3 * numpy.random.randn(n_samples, options['ctx_dim'])
+    init_ctx = numpy.asarray(init_ctx, dtype='float32').reshape([n_samples, options['ctx_dim']])
+
+    order = numpy.argsort([len(s) for s in seqs], kind='mergesort')
+    batches = [order[ii:ii+batch_size] for ii in xrange(0, n_samples, batch_size)]
+    jobs = [([seqs[t] for t in idx], init_ctx[idx]) for idx in batches]
+    kwargs = {'maxiter': maxiter, 'lrate': lrate, 'tol': tol, 'patience': patience}
+
+    ctx = numpy.zeros_like(init_ctx)
+    cost = numpy.zeros(n_samples, dtype='float32')
+    n_iters = numpy.zeros(n_samples, dtype='int64')
+
+    if n_jobs > 1:
+        import multiprocessing
+        _infer_job.update(f_cost_grad=f_cost_grad, kwargs=kwargs)
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            results = pool.imap(_infer_ctx_job, jobs)
+            for idx, res in zip(batches, results):
+                ctx[idx], cost[idx], n_iters[idx] = res
+        finally:
+            pool.close()
+            pool.join()
+            _infer_job.clear()
+    else:
+        for bidx, (idx, (bseqs, bctx)) in enumerate(zip(batches, jobs)):
+            ctx[idx], cost[idx], n_iters[idx] = _infer_ctx_minibatch(bseqs, bctx, f_cost_grad, **kwargs)
+            if verbose:
+                print 'Minibatch %d/%d: mean cost %f, mean iterations %.1f'%(
+                    bidx+1, len(batches), cost[idx].mean(), n_iters[idx].mean())
+
+    return ctx, cost, n_iters
+
+# candidate vocabulary for shortlist decoding: <eos>, UNK, the n_frequent
+# most frequent words (ids are given by decreasing frequency) and the
+# n_related words the context readout scores highest for each context
+def make_shortlist(tparams, logit_ctx, n_frequent=10000, n_related=0):
+    W = tparams['ff_logit_W'].get_value(borrow=True)
+    ids = [numpy.arange(min(max(n_frequent, 2), W.shape[1]))]
+    if n_related > 0:
+        scores = numpy.tanh(logit_ctx).dot(W) + tparams['ff_logit_b'].get_value(borrow=True)
+        n_related = min(n_related, W.shape[1])
+        ids.append(numpy.argpartition(-scores, n_related-1, axis=1)[:,:n_related].flatten())
+    return numpy.unique(numpy.concatenate(ids)).astype('int64')
+
 # generate sample
+# shortlist (an int) restricts the output to make_shortlist(..., shortlist,
+# n_related) and needs f_next from build_sampler(..., shortlist=True)
 def gen_sample(tparams, f_init, f_next, ctx, 
                options, trng=None, k=1, maxlen=30, stochastic=False,
-               allow_unk=True):
+               allow_unk=True, shortlist=None, n_related=0):
     if len(ctx.shape) == 1:
         ctx = ctx.reshape([1, ctx.shape[0]])
-    ctx0 = ctx
 
     if k > 1:
         assert not stochastic, 'Beam search does not support stochastic sampling'
@@ -479,16 +693,26 @@ def gen_sample(tparams, f_init, f_next, ctx,
     hyp_states = []
     hyp_memories = []
 
-    next_state, next_memory = f_init(ctx)
+    next_state, next_memory, pctx0, logit_ctx0 = f_init(ctx)
     next_w = -1 * numpy.ones((live_k,)).astype('int64')
+    # shortlist position -> word id
+    words = None
+    extra = []
+    if shortlist is not None:
+        words = make_shortlist(tparams, logit_ctx0, shortlist, n_related)
+        extra = [words]
 
     for ii in xrange(maxlen):
-        ctx = numpy.tile(ctx0, [live_k, 1])
-        next_p, next_w, next_state, next_memory = f_next(next_w, ctx, next_state, next_memory)
+        pctx = numpy.tile(pctx0, [live_k, 1])
+        logit_ctx = numpy.tile(logit_ctx0, [live_k, 1])
+        next_p, next_w, next_state, next_memory = f_next(next_w, pctx, logit_ctx, next_state, next_memory, *extra)
 
         if stochastic:
             sample.append(next_w[0])
-            sample_score -= numpy.log(next_p[0,next_w[0]])
+            if words is not None:
+                sample_score -= numpy.log(next_p[0,numpy.searchsorted(words, next_w[0])])
+            else:
+                sample_score -= numpy.log(next_p[0,next_w[0]])
             if next_w[0] == 0:
                 break
         else:
@@ -502,6 +726,8 @@ def gen_sample(tparams, f_init, f_next, ctx,
             voc_size = next_p.shape[1]
             trans_indices = ranks_flat / voc_size
             word_indices = ranks_flat % voc_size
+            if words is not None:
+                word_indices = words[word_indices]
             costs = cand_flat[ranks_flat]
 
             new_hyp_samples = []
@@ -554,6 +780,119 @@ def gen_sample(tparams, f_init, f_next, ctx,
 
     return sample, sample_score
 
+# beam search for many contexts at once: the live beams of every context
+# are stacked into one f_next call, and hypotheses, scores, states and
+# memories are kept in preallocated arrays with beam slots per context;
+# with shortlist, all contexts share one shortlist (the union of theirs)
+# returns a list of samples and a list of scores per context
+def gen_sample_batch(tparams, f_init, f_next, ctx, options, k=1, maxlen=30,
+                     allow_unk=True, shortlist=None, n_related=0):
+    if len(ctx.shape) == 1:
+        ctx = ctx.reshape([1, ctx.shape[0]])
+    n_ctx = ctx.shape[0]
+    n_slots = n_ctx * k
+
+    samples = [[] for _ in xrange(n_ctx)]
+    sample_scores = [[] for _ in xrange(n_ctx)]
+
+    init_state, init_memory, pctx, logit_ctx = f_init(ctx)
+    dim = init_state.shape[1]
+    words = None
+    extra = []
+    if shortlist is not None:
+        words = make_shortlist(tparams, logit_ctx, shortlist, n_related)
+        extra = [words]
+
+    # slot s holds beam s % k of context s / k
+    owner = numpy.arange(n_slots) / k
+    hyp_words = numpy.zeros((n_slots, maxlen), dtype='int64')
+    hyp_scores = numpy.zeros(n_slots, dtype='float32')
+    live = numpy.zeros(n_slots, dtype='bool')
+    live[::k] = True
+    dead_k = numpy.zeros(n_ctx, dtype='int64')
+    state = numpy.zeros((n_slots, dim), dtype='float32')
+    memory = numpy.zeros((n_slots, dim), dtype='float32')
+    state[::k] = init_state
+    memory[::k] = init_memory
+    next_w = -1 * numpy.ones((n_slots,), dtype='int64')
+    slot_cost = numpy.empty((n_ctx, k * k), dtype='float32')
+    slot_parent = numpy.zeros((n_ctx, k * k), dtype='int64')
+    slot_word = numpy.zeros((n_ctx, k * k), dtype='int64')
+
+    # with maxlen=0 the initial empty hypotheses are dumped below
+    ii = -1
+    for ii in xrange(maxlen):
+        rows = numpy.flatnonzero(live)
+        next_p, _, next_state, next_memory = f_next(next_w[rows], pctx[owner[rows]],
+                                                    logit_ctx[owner[rows]],
+                                                    state[rows], memory[rows], *extra)
+        logp = numpy.log(next_p)
+        if not allow_unk:
+            logp[:,1] = -numpy.Inf
+        cand_scores = hyp_scores[rows][:,None] - logp
+
+        # the best k of a context use at most k words from each of its beams
+        kk = min(k, cand_scores.shape[1])
+        if kk < cand_scores.shape[1]:
+            best_words = numpy.argpartition(cand_scores, kk-1, axis=1)[:,:kk]
+        else:
+            best_words = numpy.tile(numpy.arange(kk), [rows.shape[0], 1])
+        best_costs = cand_scores[numpy.arange(rows.shape[0])[:,None], best_words]
+
+        slot_cost.fill(numpy.inf)
+        cols = (rows % k)[:,None] * k + numpy.arange(kk)[None,:]
+        slot_cost[owner[rows][:,None], cols] = best_costs
+        slot_parent[owner[rows][:,None], cols] = numpy.arange(rows.shape[0])[:,None]
+        slot_word[owner[rows][:,None], cols] = best_words
+
+        # the k best candidates of every context, in increasing cost
+        if k < k * k:
+            top = numpy.argpartition(slot_cost, k-1, axis=1)[:,:k]
+        else:
+            top = numpy.tile(numpy.arange(k), [n_ctx, 1])
+        top_cost = slot_cost[numpy.arange(n_ctx)[:,None], top]
+        order = numpy.argsort(top_cost, axis=1)
+        top = top[numpy.arange(n_ctx)[:,None], order]
+        top_cost = top_cost[numpy.arange(n_ctx)[:,None], order]
+
+        # a context keeps k - dead_k of them
+        keep = (numpy.arange(k)[None,:] < (k - dead_k)[:,None]) & numpy.isfinite(top_cost)
+        new_slots = numpy.flatnonzero(keep.flatten())
+        new_owner = new_slots / k
+        new_top = top.flatten()[new_slots]
+        parent = slot_parent[new_owner, new_top]
+        new_w = slot_word[new_owner, new_top]
+        if words is not None:
+            new_w = words[new_w]
+
+        new_words = hyp_words[rows[parent]]
+        new_words[:, ii] = new_w
+        hyp_words[new_slots] = new_words
+        hyp_scores[new_slots] = top_cost.flatten()[new_slots]
+        state[new_slots] = next_state[parent]
+        memory[new_slots] = next_memory[parent]
+        next_w[new_slots] = new_w
+        live[:] = False
+        live[new_slots] = True
+
+        # check the finished samples
+        for ss in new_slots[new_w == 0]:
+            samples[owner[ss]].append(list(hyp_words[ss, :ii+1]))
+            sample_scores[owner[ss]].append(hyp_scores[ss])
+            dead_k[owner[ss]] += 1
+            live[ss] = False
+        live &= (dead_k < k)[owner]
+
+        if not live.any():
+            break
+
+    # dump every remaining one
+    for ss in numpy.flatnonzero(live):
+        samples[owner[ss]].append(list(hyp_words[ss, :ii+1]))
+        sample_scores[owner[ss]].append(hyp_scores[ss])
+
+    return samples, sample_scores
+
 def pred_probs(f_log_probs, prepare_data, data, iterator, verbose=False):
     n_samples = len(data[0])
     probs = numpy.zeros((n_samples, 1)).astype('float32')
@@ -656,6 +995,75 @@ def sgd(lr, tparams, grads, x, mask, y, cost):
 
     return f_grad_shared, f_update
 
+# fused optimizers: one function computes the cost and gradients and
+# applies the update, without the shared gradient copies
+# name(hyperp, tparams, grads, inputs (list), cost) = f_train, None
+# where f_train(*(inputs + [lr])) returns the cost
+def adam_fused(lr, tparams, grads, inp, cost):
+    lr0 = 0.0002
+    b1 = 0.1
+    b2 = 0.001
+    e = 1e-8
+
+    updates = []
+
+    i = theano.shared(numpy.float32(0.))
+    i_t = i + 1.
+    fix1 = 1. - b1**(i_t)
+    fix2 = 1. - b2**(i_t)
+    lr_t = lr0 * (tensor.sqrt(fix2) / fix1)
+
+    for p, g in zip(tparams.values(), grads):
+        m = theano.shared(p.get_value() * 0.)
+        v = theano.shared(p.get_value() * 0.)
+        m_t = (b1 * g) + ((1. - b1) * m)
+        v_t = (b2 * tensor.sqr(g)) + ((1. - b2) * v)
+        g_t = m_t / (tensor.sqrt(v_t) + e)
+        p_t = p - (lr_t * g_t)
+        updates.append((m, m_t))
+        updates.append((v, v_t))
+        updates.append((p, p_t))
+    updates.append((i, i_t))
+
+    f_train = theano.function(inp + [lr], cost, updates=updates, on_unused_input='ignore')
+
+    return f_train, None
+
+def adadelta_fused(lr, tparams, grads, inp, cost):
+    running_up2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rup2'%k) for k, p in tparams.iteritems()]
+    running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2'%k) for k, p in tparams.iteritems()]
+
+    rg2_new = [0.95 * rg2 + 0.05 * (g ** 2) for rg2, g in zip(running_grads2, grads)]
+    updir = [-tensor.sqrt(ru2 + 1e-6) / tensor.sqrt(rg2n + 1e-6) * g for g, ru2, rg2n in zip(grads, running_up2, rg2_new)]
+    rg2up = zip(running_grads2, rg2_new)
+    ru2up = [(ru2, 0.95 * ru2 + 0.05 * (ud ** 2)) for ru2, ud in zip(running_up2, updir)]
+    param_up = [(p, p + ud) for p, ud in zip(itemlist(tparams), updir)]
+
+    f_train = theano.function(inp + [lr], cost, updates=rg2up+ru2up+param_up, on_unused_input='ignore')
+
+    return f_train, None
+
+def rmsprop_fused(lr, tparams, grads, inp, cost):
+    running_grads = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad'%k) for k, p in tparams.iteritems()]
+    running_grads2 = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_rgrad2'%k) for k, p in tparams.iteritems()]
+    updir = [theano.shared(p.get_value() * numpy.float32(0.), name='%s_updir'%k) for k, p in tparams.iteritems()]
+
+    rg_new = [0.95 * rg + 0.05 * g for rg, g in zip(running_grads, grads)]
+    rg2_new = [0.95 * rg2 + 0.05 * (g ** 2) for rg2, g in zip(running_grads2, grads)]
+    updir_new = [0.9 * ud - 1e-4 * g / tensor.sqrt(rg2n - rgn ** 2 + 1e-4) for ud, g, rgn, rg2n in zip(updir, grads, rg_new, rg2_new)]
+    rgup = zip(running_grads, rg_new) + zip(running_grads2, rg2_new)
+    param_up = [(p, p + udn) for p, udn in zip(itemlist(tparams), updir_new)]
+
+    f_train = theano.function(inp + [lr], cost, updates=rgup+zip(updir, updir_new)+param_up, on_unused_input='ignore')
+
+    return f_train, None
+
+def sgd_fused(lr, tparams, grads, inp, cost):
+    pup = [(p, p - lr * g) for p, g in zip(itemlist(tparams), grads)]
+    f_train = theano.function(inp + [lr], cost, updates=pup)
+
+    return f_train, None
+
 
 def train(dim_word=100, # word vector dimensionality
           ctx_dim=512, # context vector dimensionality
@@ -678,6 +1086,10 @@ def train(dim_word=100, # word vector dimensionality
           sampleFreq=100, # generate some samples after every sampleFreq updates
           dictionary=None, # word dictionary
           use_dropout=False,
+          bucket=False, # batch definitions of similar length together
+          token_budget=None, # with bucket, cap padded tokens per batch instead of batch_size
+          prefetch=2, # number of minibatches built ahead in a background thread (0 = off)
+          n_sampled=0, # negative words per minibatch for a sampled-softmax cost (0 = full softmax)
           reload_=False):
 
     # Model options
@@ -701,6 +1113,7 @@ def train(dim_word=100, # word vector dimensionality
 
     print 'Loading data'
     load_data, prepare_data = load_prepare_data.load_data, load_prepare_data.prepare_data
+    build_batch = load_prepare_data.BatchBuilder(n_buffers=prefetch+2)
     train, valid, test = load_data(data_name=dataset, n_words=n_words, valid_portion=0.1)
 
     print 'Building model'
@@ -722,6 +1135,13 @@ def train(dim_word=100, # word vector dimensionality
     # before any regularizer
     f_log_probs = theano.function([x, mask, ctx], -cost)
 
+    # train on a sampled softmax; f_log_probs above stays exact for validation
+    if n_sampled > 0:
+        trng, use_noise, \
+              x, mask, ctx, \
+              cost = \
+              build_model(tparams, model_options, test=False, n_sampled=n_sampled)
+
     cost = cost.mean()
 
     if decay_c > 0.:
@@ -762,28 +1182,41 @@ def train(dim_word=100, # word vector dimensionality
     if sampleFreq == -1:
         sampleFreq = len(train[0])/batch_size
 
+    if bucket:
+        train_lengths = load_prepare_data.seq_lengths(train[1])
+
     uidx = 0
     estop = False
     for eidx in xrange(max_epochs):
         n_samples = 0
 
-        kf = KFold(len(train[0]), n_folds=len(train[0])/batch_size, shuffle=True)
+        if bucket:
+            kf = load_prepare_data.bucket_minibatches_idx(train_lengths, batch_size, 
+                                                          token_budget=token_budget)
+            print 'Padding efficiency %.3f'%load_prepare_data.padding_efficiency(train_lengths, kf)
+        else:
+            kf = KFold(len(train[0]), n_folds=len(train[0])/batch_size, shuffle=True)
+
+        if prefetch > 0:
+            batches = load_prepare_data.prefetch_batches(build_batch, train[1], train[0], kf,
+                                                         maxlen=maxlen, n_prefetch=prefetch)
+        else:
+            batches = ((idx,) + build_batch(train[1], train[0], idx, maxlen=maxlen) for _, idx in kf)
 
-        for _, train_index in kf:
+        for train_index, x, mask, ctx in batches:
             n_samples += train_index.shape[0]
             uidx += 1
             use_noise.set_value(1.)
 
-            x, mask, ctx = prepare_data([train[1][t] for t in train_index], 
-                                        [train[0][t] for t in train_index], 
-                                        maxlen=maxlen)
-
-            if x == None:
+            if x is None:
                 print 'Minibatch with zero sample under length ', maxlen
                 continue
 
-            cost = f_grad_shared(x, mask, ctx)
-            f_update(lrate)
+            if f_update is None:
+                cost = f_grad_shared(x, mask, ctx, lrate)
+            else:
+                cost = f_grad_shared(x, mask, ctx)
+                f_update(lrate)
 
             if numpy.isnan(cost) or numpy.isinf(cost):
                 print 'NaN detected'
@@ -189,6 +189,9 @@ def train(dim_word=100, # word vector dimensionality
           sampleFreq=100, # generate some samples after every sampleFreq updates
           dictionary=None, # word dictionary
           use_dropout=False,
+          bucket=False, # batch definitions of similar length together
+          token_budget=None, # with bucket, cap padded tokens per batch instead of batch_size
+          prefetch=2, # number of minibatches built ahead in a background thread (0 = off)
           reload_=False):
 
     # Model options
@@ -212,6 +215,7 @@ def train(dim_word=100, # word vector dimensionality
 
     print 'Loading data'
     load_data, prepare_data = load_prepare_data.load_data, load_prepare_data.prepare_data
+    build_batch = load_prepare_data.BatchBuilder(n_buffers=prefetch+2)
     train, valid, test = load_data(data_name=dataset, n_words=n_words, valid_portion=0.1)
 
     print 'Building model'
@@ -270,28 +274,41 @@ def train(dim_word=100, # word vector dimensionality
     if sampleFreq == -1:
         sampleFreq = len(train[0])/batch_size
 
+    if bucket:
+        train_lengths = load_prepare_data.seq_lengths(train[1])
+
     uidx = 0
     estop = False
     for eidx in xrange(max_epochs):
         n_samples = 0
 
-        kf = KFold(len(train[0]), n_folds=len(train[0])/batch_size, shuffle=True)
+        if bucket:
+            kf = load_prepare_data.bucket_minibatches_idx(train_lengths, batch_size, 
+                                                          token_budget=token_budget)
+            print 'Padding efficiency %.3f'%load_prepare_data.padding_efficiency(train_lengths, kf)
+        else:
+            kf = KFold(len(train[0]), n_folds=len(train[0])/batch_size, shuffle=True)
+
+        if prefetch > 0:
+            batches = load_prepare_data.prefetch_batches(build_batch, train[1], train[0], kf,
+                                                         maxlen=maxlen, n_prefetch=prefetch)
+        else:
+            batches = ((idx,) + build_batch(train[1], train[0], idx, maxlen=maxlen) for _, idx in kf)
 
-        for _, train_index in kf:
+        for train_index, x, mask, ctx in batches:
             n_samples += train_index.shape[0]
             uidx += 1
             use_noise.set_value(1.)
 
-            x, mask, ctx = prepare_data([train[1][t] for t in train_index], 
-                                        [train[0][t] for t in train_index], 
-                                        maxlen=maxlen)
-
-            if x == None:
+            if x is None:
                 print 'Minibatch with zero sample under length ', maxlen
                 continue
 
-            cost = f_grad_shared(x, mask, ctx)
-            f_update(lrate)
+            if f_update is None:
+                cost = f_grad_shared(x, mask, ctx, lrate)
+            else:
+                cost = f_grad_shared(x, mask, ctx)
+                f_update(lrate)
 
             if numpy.isnan(cost) or numpy.isinf(cost):
                 print 'NaN detected'
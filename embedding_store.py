@@ -0,0 +1,85 @@
+'''
+Memory-mapped float32 word embedding store
+
+A store with prefix P consists of
+    P.npy        #words x dim float32 matrix, rows normalized to unit length
+    P.norms.npy  #words float32 vector with the original row norms
+    P.vocab      one word per line, line i is the word of row i
+'''
+import cPickle as pkl
+import numpy
+import os
+import sys
+
+
+class EmbeddingStore(object):
+    '''
+    Word -> vector mapping backed by a (possibly memory-mapped) matrix.
+
+    `store[w]` and `w in store` behave like the pickled {word: vector} dict
+    (vectors are returned with their original norm), while `vectors` holds
+    the normalized matrix used for cosine similarity.
+    '''
+    def __init__(self, words, vectors, norms):
+        self.words = words
+        self.vectors = vectors
+        self.norms = norms
+        self.word_idx = dict((ww, ii) for ii, ww in enumerate(words))
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.word_idx
+
+    def __getitem__(self, word):
+        ii = self.word_idx[word]
+        return self.vectors[ii] * self.norms[ii]
+
+# convert a pickled {word: vector} dict into a store with prefix `prefix`
+def convert_embeddings(pkl_path, prefix):
+    with open(pkl_path, 'rb') as f:
+        wv = pkl.load(f)
+    n_words = len(wv)
+    dim = wv.itervalues().next().shape[0]
+
+    vectors = numpy.lib.format.open_memmap('%s.npy'%prefix, mode='w+',
+                                           dtype='float32', shape=(n_words, dim))
+    norms = numpy.zeros((n_words,), dtype='float32')
+    with open('%s.vocab'%prefix, 'wb') as f:
+        for ii, (kk, vv) in enumerate(wv.iteritems()):
+            norms[ii] = numpy.sqrt((vv ** 2).sum())
+            vectors[ii,:] = vv / norms[ii]
+            if isinstance(kk, unicode):
+                kk = kk.encode('utf-8')
+            f.write(kk + '\n')
+    vectors.flush()
+    del vectors
+    numpy.save('%s.norms.npy'%prefix, norms)
+
+# load either a store prefix (memory-mapped) or a legacy pickle; a path is
+# a store if its .npy and .vocab files exist, anything else is unpickled
+def load_embeddings(path, mmap_mode='r'):
+    prefix = path[:-len('.npy')] if path.endswith('.npy') else path
+    if not (os.path.exists('%s.npy'%prefix) and os.path.exists('%s.vocab'%prefix)):
+        with open(path, 'rb') as f:
+            wv = pkl.load(f)
+        words = wv.keys()
+        vectors = numpy.array([wv[ww] for ww in words], dtype='float32')
+        norms = numpy.sqrt((vectors ** 2).sum(axis=1))
+        vectors /= norms[:,None]
+        return EmbeddingStore(words, vectors, norms)
+
+    vectors = numpy.load('%s.npy'%prefix, mmap_mode=mmap_mode)
+    norms = numpy.load('%s.norms.npy'%prefix)
+    with open('%s.vocab'%prefix, 'rb') as f:
+        words = f.read().split('\n')[:-1]
+    assert len(words) == vectors.shape[0], 'vocabulary and matrix are not aligned'
+    return EmbeddingStore(words, vectors, norms)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'usage: python embedding_store.py embeddings.pkl output_prefix'
+    else:
+        convert_embeddings(sys.argv[1], sys.argv[2])
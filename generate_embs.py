@@ -1,102 +1,336 @@
-import theano
-from theano import tensor
-from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
-
 import argparse
 
 import numpy
 import cPickle as pkl
 
-import urllib2
-import urllib
+import json
+import sys
+import os
+
+from nn_index import NNIndex, index_path
+from embedding_store import load_embeddings
+from load_prepare_data import prepare_data
+from candidate_sources import FunctionSource, external_sources, gather
+from lookup_cache import LookupCache, QueryCache
+
+# load the reverse dictionary encoder and compile its forward pass;
+# engine='numpy' skips Theano (and its imports/compilation) altogether
+def load_encoder(model, engine='theano'):
+    if engine == 'numpy':
+        from numpy_fprop import load_model, build_numpy_fprop
+        model_options, params = load_model(model)
+        return model_options, build_numpy_fprop(params, model_options)
+
+    import theano
+    from theano.sandbox.rng_mrg import MRG_RandomStreams as RandomStreams
+    from defgen_rev import build_fprop, \
+                           load_params, \
+                           init_params, \
+                           init_tparams
+
+    with open('%s.pkl'%model, 'rb') as f:
+        model_options = pkl.load(f)
+
+    trng = RandomStreams(1234)
+    use_noise = theano.shared(numpy.float32(0.), name='use_noise')
+
+    params = init_params(model_options)
+    params = load_params(model, params)
+    tparams = init_tparams(params)
 
-from defgen_rev import build_fprop, \
+    f_prop = build_fprop(tparams, model_options, trng, use_noise)
+
+    return model_options, f_prop
+
+# load the defgen definition generator and compile the log-probability of
+# a definition given a word vector, for re-ranking
+def load_scorer(model):
+    import theano
+    from defgen import build_model, \
                        load_params, \
                        init_params, \
-                       init_tparams, \
-                       zipp
+                       init_tparams
 
-def main(model, 
-         dictionary,
-         embeddings):
-
-    # load model model_options
     with open('%s.pkl'%model, 'rb') as f:
         model_options = pkl.load(f)
 
+    params = init_params(model_options)
+    params = load_params(model, params)
+    tparams = init_tparams(params)
+
+    trng, use_noise, x, mask, ctx, cost = build_model(tparams, model_options)
+    f_log_probs = theano.function([x, mask, ctx], -cost, name='f_log_probs')
+
+    return model_options, f_log_probs
+
+# load a saved nearest-neighbour index over the embeddings, or build one
+# (and save it) if there is none or it was built for other embeddings
+def load_index(wv, index=None, index_mode='exact', nprobe=8):
+    if index:
+        index = index_path(index)
+    if index and os.path.exists(index):
+        try:
+            nn = NNIndex.load(index, wv.vectors, wv.words)
+            nn.nprobe = nprobe
+            return nn
+        except ValueError as e:
+            print >>sys.stderr, '%s, rebuilding it'%e
+    nn = NNIndex(wv.vectors, words=wv.words, mode=index_mode, nprobe=nprobe)
+    if index:
+        nn.save(index)
+    return nn
+
+# identity of the files a cache entry depends on
+def fingerprint(*paths):
+    stamp = []
+    for path in paths:
+        if path is None:
+            continue
+        for fn in [path, '%s.pkl'%path, '%s.npy'%path]:
+            if os.path.exists(fn):
+                st = os.stat(fn)
+                stamp.append((os.path.abspath(fn), st.st_size, st.st_mtime))
+    return tuple(stamp)
+
+def tokenize(worddict, description):
+    return tuple(worddict[w] if w in worddict else 1 for w in description.strip().split())
+
+# encode a list of descriptions in one f_prop call, rows normalized;
+# with a QueryCache only the unseen token sequences are encoded
+def encode(f_prop, worddict, descriptions, cache=None):
+    seqs = [tokenize(worddict, d) for d in descriptions]
+    vecs = [cache.get(('vec', seq)) if cache else None for seq in seqs]
+    todo = [ii for ii, vv in enumerate(vecs) if vv is None]
+    if todo:
+        x, mask, _ = prepare_data([seqs[ii] for ii in todo], [None] * len(todo))
+        new_vecs = f_prop(x, mask)
+        new_vecs = new_vecs / numpy.sqrt((new_vecs ** 2).sum(axis=1))[:,None]
+        for ii, vv in zip(todo, new_vecs):
+            vecs[ii] = vv
+            if cache:
+                cache.put(('vec', seqs[ii]), vv)
+    return numpy.array(vecs)
+
+# re-rank first-stage (ids, scores) by the log-probability defgen assigns
+# to each description given each candidate's (normalized) vector; the
+# (description, candidate) pairs are scored max_pairs at a time. Words
+# outside the scorer's n_words vocabulary are scored as UNK.
+def rerank(f_log_probs, worddict, nn, descriptions, ranked, k=10, n_words=None, max_pairs=1000):
+    seqs = [tokenize(worddict, d) for d in descriptions]
+    if n_words is not None:
+        seqs = [tuple(w if w < n_words else 1 for w in seq) for seq in seqs]
+    cands = [ids[ids >= 0] for ids, _ in ranked]
+    pairs = [seq for seq, ids in zip(seqs, cands) for _ in ids]
+    reranked = [(ids, numpy.zeros((0,), dtype='float32')) for ids in cands]
+    if not pairs:
+        return reranked
+
+    cand_ids = numpy.concatenate(cands)
+    log_probs = []
+    for start in xrange(0, len(pairs), max_pairs):
+        x, mask, _ = prepare_data(pairs[start:start+max_pairs], None)
+        log_probs.append(f_log_probs(x, mask, nn.vectors[cand_ids[start:start+max_pairs]]))
+    log_probs = numpy.concatenate(log_probs)
+
+    start = 0
+    for ii, ids in enumerate(cands):
+        lp = log_probs[start:start+ids.shape[0]]
+        start += ids.shape[0]
+        order = numpy.argsort(-lp, kind='mergesort')[:k]
+        reranked[ii] = (ids[order], lp[order])
+    return reranked
+
+# top-k (ids, scores) for every description, reusing cached rankings;
+# with f_log_probs, the top n_rerank by similarity are re-ranked (rerank)
+# and the scores are defgen log-probabilities
+def rank(f_prop, worddict, nn, descriptions, k=10, cache=None, f_log_probs=None, n_rerank=100,
+         n_words=None):
+    if f_log_probs is not None:
+        seqs = [tokenize(worddict, d) for d in descriptions]
+        ranked = [cache.get(('rerank', seq, k, n_rerank)) if cache else None for seq in seqs]
+        todo = [ii for ii, rr in enumerate(ranked) if rr is None]
+        if todo:
+            todo_desc = [descriptions[ii] for ii in todo]
+            first = rank(f_prop, worddict, nn, todo_desc, max(k, n_rerank), cache)
+            for ii, rr in zip(todo, rerank(f_log_probs, worddict, nn, todo_desc, first, k, n_words)):
+                ranked[ii] = rr
+                if cache:
+                    cache.put(('rerank', seqs[ii], k, n_rerank), rr)
+        return ranked
+
+    seqs = [tokenize(worddict, d) for d in descriptions]
+    ranked = [cache.get(('topk', seq, k)) if cache else None for seq in seqs]
+    todo = [ii for ii, rr in enumerate(ranked) if rr is None]
+    if todo:
+        idx, sims = nn.search(encode(f_prop, worddict, [descriptions[ii] for ii in todo], cache), k=k)
+        for ii, ids, scores in zip(todo, idx, sims):
+            ranked[ii] = (ids, scores)
+            if cache:
+                cache.put(('topk', seqs[ii], k), ranked[ii])
+    return ranked
+
+# rank candidates for every line of `infile` and write them as JSONL
+def batch_query(f_prop, worddict, nn, infile, outfile, batch_size=128, k=10, cache=None,
+                f_log_probs=None, n_rerank=100, n_words=None):
+    def _flush(descriptions):
+        for d, (ii, ss) in zip(descriptions, rank(f_prop, worddict, nn, descriptions, k, cache,
+                                                  f_log_probs, n_rerank, n_words)):
+            outfile.write(json.dumps({'query': d, 
+                                      'candidates': [[nn.words[w], float(sc)] for w, sc in zip(ii, ss)]}) + '\n')
+
+    n_done = 0
+    descriptions = []
+    for line in infile:
+        if not line.strip():
+            continue
+        descriptions.append(line.strip())
+        if len(descriptions) == batch_size:
+            _flush(descriptions)
+            n_done += len(descriptions)
+            descriptions = []
+            if numpy.mod(n_done, 100 * batch_size) == 0:
+                print >>sys.stderr, '%d queries done'%n_done
+    if descriptions:
+        _flush(descriptions)
+
+def main(model, 
+         dictionary,
+         embeddings,
+         index=None,
+         index_mode='exact',
+         nprobe=8,
+         batch=None,
+         output=None,
+         batch_size=128,
+         k=10,
+         candidate_sources=('datamuse',),
+         source_timeout=2.,
+         stub_table=None,
+         stub_delay=0.,
+         cache=None,
+         cache_ttl=7*24*3600.,
+         cache_size=100000,
+         query_cache_size=10000,
+         engine='theano',
+         rerank_model=None,
+         n_rerank=100):
+
     with open(dictionary, 'rb') as f:
         worddict = pkl.load(f)
     worddict_r = dict()
-    for k, v in worddict.iteritems():
-        worddict_r[v] = k
+    for kk, vv in worddict.iteritems():
+        worddict_r[vv] = kk
     worddict_r[0] = '<eos>'
 
-    print 'Loading skipgram vectors...',
-    with open(embeddings, 'rb') as f:
-        wv = pkl.load(f)
-    wv_vectors = numpy.zeros((len(wv.keys()), wv.values()[0].shape[0]))
-    wv_words = [None] * len(wv.keys())
-    for ii, (kk, vv) in enumerate(wv.iteritems()):
-        wv_vectors[ii,:] = vv
-        wv_words[ii] = kk
-    wv_vectors = wv_vectors / (numpy.sqrt((wv_vectors ** 2).sum(axis=1))[:,None])
-    print 'Done' 
+    print >>sys.stderr, 'Loading skipgram vectors...',
+    wv = load_embeddings(embeddings)
+    wv_words = wv.words
+    print >>sys.stderr, 'Done' 
 
-    trng = RandomStreams(1234)
-    use_noise = theano.shared(numpy.float32(0.), name='use_noise')
+    # nearest-neighbour index, built once and reused if saved
+    print >>sys.stderr, 'Loading index...',
+    nn = load_index(wv, index, index_mode, nprobe)
+    print >>sys.stderr, 'Done'
 
-    params = init_params(model_options)
+    model_options, f_prop = load_encoder(model, engine)
 
-    params = load_params(model, params)
-    tparams = init_tparams(params)
+    # optional second stage: re-rank by defgen likelihood
+    f_log_probs = None
+    scorer_words = None
+    if rerank_model:
+        print >>sys.stderr, 'Loading re-ranking model...',
+        scorer_options, f_log_probs = load_scorer(rerank_model)
+        scorer_words = scorer_options['n_words']
+        print >>sys.stderr, 'Done'
+
+    # encoded descriptions and rankings, valid for this model/embeddings only
+    query_cache = None
+    if query_cache_size > 0:
+        query_cache = QueryCache(query_cache_size, fingerprint(model, embeddings, index, rerank_model))
+
+    if batch:
+        infile = sys.stdin if batch == '-' else open(batch, 'rb')
+        outfile = sys.stdout if output in (None, '-') else open(output, 'wb')
+        batch_query(f_prop, worddict, nn, infile, outfile, batch_size=batch_size, k=k, cache=query_cache,
+                    f_log_probs=f_log_probs, n_rerank=n_rerank, n_words=scorer_words)
+        outfile.flush()
+        return
+
+    def _rnn(query):
+        idx, sims = rank(f_prop, worddict, nn, [query], k, query_cache, f_log_probs, n_rerank,
+                         scorer_words)[0]
+        return zip(idx, sims)
+
+    def _w2v(query):
+        seq_embs = numpy.array([wv[w] for w in query.strip().split() if w in wv])
+        if seq_embs.shape[0] == 0:
+            return []
+        idx, sims = nn.search(numpy.sum(seq_embs, axis=0), k=k)
+        return zip(idx[0], sims[0])
+
+    # the RNN ranking, the w2v additive baseline and any external
+    # sources are all queried concurrently
+    lookup_cache = LookupCache(cache, ttl=cache_ttl, max_entries=cache_size) if cache else None
+    local_sources = [FunctionSource('RNN', _rnn), FunctionSource('w2v', _w2v)]
+    sources = local_sources + external_sources(candidate_sources, timeout=source_timeout,
+                                               stub_table=stub_table, stub_delay=stub_delay,
+                                               cache=lookup_cache)
 
-    # word index
-    f_prop = build_fprop(tparams, model_options, trng, use_noise)
-    
     while True:
         wordin = raw_input('Type a description (case-probably-sensitive): ')
         words = wordin.strip().split()
-        seq = [worddict[w] if w in worddict else 1 for w in words] + [0]
-        seq_embs = numpy.array([wv[w] for w in words if w in wv])
-        linemb = numpy.sum(seq_embs, axis=0)
         print 'Unknown words: ',
         for w in words:
             if w not in worddict:
                 print w,
         print
 
-        vec = f_prop(numpy.array(seq).reshape([len(seq),1]).astype('int64'),
-                     numpy.ones((len(seq),1)).astype('float32'))
-        vec = vec / numpy.sqrt((vec ** 2).sum(axis=1))[:,None]
-        sims_rnn = (wv_vectors * vec).sum(1)
-        sorted_idx_rnn = sims_rnn.argsort()[::-1]
-        sims_w2v = (wv_vectors * linemb).sum(1)
-        sorted_idx_w2v = sims_w2v.argsort()[::-1]
-        query = urllib.urlencode([("rd", wordin.strip())])
-        ret = urllib2.urlopen("http://api.datamuse.com/words?max=1000&"+query).read()
-        wordlist = [s['word'] for s in eval(ret)]
-
-
-        print 'RNN candidates: '
-        for ii, s in enumerate(sorted_idx_rnn[:10]):
-            print '', ii, '(', sims_rnn[s],')-', wv_words[s]
-        print
-        print 'w2v candidates: '
-        for ii, s in enumerate(sorted_idx_w2v[:10]):
-            print '', ii, '(', sims_w2v[s],')-', wv_words[s]
-        print
-        print 'OneLook candidates: '
-        for ii, s in enumerate(wordlist[:10]):
-            print '', ii, s
-        print
+        results = gather(sources, wordin, verbose=True)
 
+        for src in local_sources:
+            print '%s candidates: '%src.name
+            for ii, (s, sim) in enumerate(results[src.name] or []):
+                print '', ii, '(', sim,')-', wv_words[s]
+            print
+        for src in sources[len(local_sources):]:
+            print '%s candidates: '%src.name
+            for ii, s in enumerate((results[src.name] or [])[:k]):
+                print '', ii, s
+            print
+        if lookup_cache:
+            print 'Lookup cache: %(hits)d hits, %(misses)d misses'%lookup_cache.stats()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-m','--model', type=str)
-    parser.add_argument('-e','--embeddings',type=str)
+    parser.add_argument('-e','--embeddings',type=str, help='embedding pickle or memory-mapped store prefix')
     parser.add_argument('-dic','--dictionary',type=str)
+    parser.add_argument('-i','--index',type=str, help='nearest-neighbour index file (built and saved if missing)')
+    parser.add_argument('--index_mode',type=str, default='exact', help='exact or ivf')
+    parser.add_argument('--nprobe',type=int, default=8, help='number of lists probed by the ivf index')
+    parser.add_argument('--engine',type=str, default='theano', help='encoder implementation: theano or numpy')
+    parser.add_argument('-b','--batch',type=str, help='file of descriptions (one per line, - for stdin) to answer non-interactively')
+    parser.add_argument('-o','--output',type=str, help='JSONL output file for batch mode (default stdout)')
+    parser.add_argument('--batch_size',type=int, default=128)
+    parser.add_argument('-k','--topk',type=int, default=10, help='number of candidates per query')
+    parser.add_argument('--sources',type=str, default='datamuse', help='comma-separated external candidate sources: datamuse, stub or none')
+    parser.add_argument('--source_timeout',type=float, default=2., help='seconds to wait for each external source')
+    parser.add_argument('--stub_table',type=str, help='JSON {query: [words]} file answered by the stub source')
+    parser.add_argument('--stub_delay',type=float, default=0., help='artificial latency of the stub source in seconds')
+    parser.add_argument('--cache',type=str, help='SQLite file caching external lookups')
+    parser.add_argument('--cache_ttl',type=float, default=7*24*3600., help='seconds before a cached lookup expires')
+    parser.add_argument('--cache_size',type=int, default=100000, help='maximum number of cached lookups')
+    parser.add_argument('--query_cache_size',type=int, default=10000, help='in-process LRU entries for encoded descriptions (0 disables)')
+    parser.add_argument('-r','--rerank',type=str, help='defgen model re-ranking the top candidates by the likelihood of the description')
+    parser.add_argument('--n_rerank',type=int, default=100, help='number of similarity candidates re-ranked')
     args = parser.parse_args()
 
-    main(args.model, dictionary=args.dictionary,embeddings=args.embeddings)
+    main(args.model, dictionary=args.dictionary,embeddings=args.embeddings,
+         index=args.index, index_mode=args.index_mode, nprobe=args.nprobe,
+         batch=args.batch, output=args.output, batch_size=args.batch_size, k=args.topk,
+         candidate_sources=args.sources.split(','), source_timeout=args.source_timeout,
+         stub_table=args.stub_table, stub_delay=args.stub_delay,
+         cache=args.cache, cache_ttl=args.cache_ttl, cache_size=args.cache_size,
+         query_cache_size=args.query_cache_size, engine=args.engine,
+         rerank_model=args.rerank, n_rerank=args.n_rerank)
@@ -7,10 +7,10 @@ import argparse
 import numpy
 import cPickle as pkl
 
-
-import urllib2
-import urllib
-
+from embedding_store import load_embeddings
+from pattern_index import PatternIndex
+from candidate_sources import FunctionSource, external_sources, gather
+from lookup_cache import LookupCache
 from defgen_rev import build_fprop, \
                        load_params, \
                        init_params, \
@@ -31,7 +31,14 @@ def combine(ranking_1, ranking_2, cutoff):
 
 def main(model, 
          dictionary,
-         embeddings):
+         embeddings,
+         candidate_sources=('datamuse',),
+         source_timeout=2.,
+         stub_table=None,
+         stub_delay=0.,
+         cache=None,
+         cache_ttl=7*24*3600.,
+         cache_size=100000):
 
     # load model model_options
     with open('%s.pkl'%model, 'rb') as f:
@@ -45,14 +52,13 @@ def main(model,
     worddict_r[0] = '<eos>'
 
     print 'Loading skipgram vectors...',
-    with open(embeddings, 'rb') as f:
-        wv = pkl.load(f)
-    wv_vectors = numpy.zeros((len(wv.keys()), wv.values()[0].shape[0]))
-    wv_words = [None] * len(wv.keys())
-    for ii, (kk, vv) in enumerate(wv.iteritems()):
-        wv_vectors[ii,:] = vv
-        wv_words[ii] = kk
-    wv_vectors = wv_vectors / (numpy.sqrt((wv_vectors ** 2).sum(axis=1))[:,None])
+    wv = load_embeddings(embeddings)
+    wv_vectors = wv.vectors
+    wv_words = wv.words
+    print 'Done'
+
+    print 'Building pattern index...',
+    patterns = PatternIndex(wv_words)
     print 'Done'
 
     trng = RandomStreams(1234)
@@ -65,6 +71,11 @@ def main(model,
 
     # word index
     f_prop = build_fprop(tparams, model_options, trng, use_noise)
+
+    lookup_cache = LookupCache(cache, ttl=cache_ttl, max_entries=cache_size) if cache else None
+    ext_sources = external_sources(candidate_sources, timeout=source_timeout,
+                                   stub_table=stub_table, stub_delay=stub_delay,
+                                   cache=lookup_cache)
     
     while True:
         wordin = raw_input('Type a description (case-probably-sensitive): ')
@@ -91,18 +102,28 @@ def main(model,
                 print w,
         print
 
-        vec = f_prop(numpy.array(seq).reshape([len(seq),1]).astype('int64'),
-                     numpy.ones((len(seq),1)).astype('float32'))
-        vec = vec / numpy.sqrt((vec ** 2).sum(axis=1))[:,None]
-        sims_rnn = (wv_vectors * vec).sum(1)
-        sorted_idx_rnn = sims_rnn.argsort()[::-1]
-        sims_w2v = (wv_vectors * linemb).sum(1)
-        sorted_idx_w2v = sims_w2v.argsort()[::-1]
-        query = urllib.urlencode([("rd", wordin.strip())])
-        ret = urllib2.urlopen("http://api.datamuse.com/words?max=1000&"+query).read()
-        wordlist = [s['word'] for s in eval(ret)]
-        
-        
+        # only score the words that fit the length and form
+        cands = patterns.lookup(form)
+        cand_vectors = wv_vectors[cands]
+
+        def _rnn(query):
+            vec = f_prop(numpy.array(seq).reshape([len(seq),1]).astype('int64'),
+                         numpy.ones((len(seq),1)).astype('float32'))
+            vec = vec / numpy.sqrt((vec ** 2).sum(axis=1))[:,None]
+            sims = cand_vectors.dot(vec[0])
+            return [(cands[s], sims[s]) for s in sims.argsort()[::-1][:10]]
+
+        def _w2v(query):
+            if seq_embs.shape[0] == 0:
+                return []
+            sims = cand_vectors.dot(linemb)
+            return [(cands[s], sims[s]) for s in sims.argsort()[::-1][:10]]
+
+        # local rankings and external sources are queried concurrently
+        local_sources = [FunctionSource('RNN', _rnn), FunctionSource('w2v', _w2v)]
+        sources = local_sources + ext_sources
+        results = gather(sources, wordin, verbose=True)
+
         def match(word,word_len,knowndict):
             if len(word) != word_len:
                 return False
@@ -113,35 +134,24 @@ def main(model,
                     return True
                 else:
                     return False
-        counter = 0
-        print 'RNN candidates: '
-        for ii, s in enumerate(sorted_idx_rnn):
-            if counter <= 10:
-                if match(wv_words[s], query_len, knowns):
-                    print  ii, '(', sims_rnn[s],')-', wv_words[s]
-                    counter +=1
-            else:
-                break
-        print
-        print 'w2v candidates: '
-        counter = 0
-        for ii, s in enumerate(sorted_idx_w2v):
-            if counter <= 10:
-                if match(wv_words[s], query_len, knowns):
-                    print  ii, '(', sims_w2v[s],')-', wv_words[s]
-                    counter +=1
-            else:
-                break
-
-        print 'OneLook: '
-        counter = 0
-        for ii, s in enumerate(wordlist):
-            if counter <= 10:
-                if match(s, query_len, knowns):
-                    print  ii, s
-                    counter +=1
-            else:
-                break
+        for src in local_sources:
+            print '%s candidates: '%src.name
+            for ii, (s, sim) in enumerate(results[src.name] or []):
+                print  ii, '(', sim,')-', wv_words[s]
+            print
+
+        for src in ext_sources:
+            print '%s: '%src.name
+            counter = 0
+            for ii, s in enumerate(results[src.name] or []):
+                if counter <= 10:
+                    if match(s, query_len, knowns):
+                        print  ii, s
+                        counter +=1
+                else:
+                    break
+        if lookup_cache:
+            print 'Lookup cache: %(hits)d hits, %(misses)d misses'%lookup_cache.stats()
 
 
         
@@ -150,8 +160,18 @@ def main(model,
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-m','--model', type=str)
-    parser.add_argument('-e','--embeddings',type=str)
+    parser.add_argument('-e','--embeddings',type=str, help='embedding pickle or memory-mapped store prefix')
     parser.add_argument('-dic','--dictionary',type=str)
+    parser.add_argument('--sources',type=str, default='datamuse', help='comma-separated external candidate sources: datamuse, stub or none')
+    parser.add_argument('--source_timeout',type=float, default=2., help='seconds to wait for each external source')
+    parser.add_argument('--stub_table',type=str, help='JSON {query: [words]} file answered by the stub source')
+    parser.add_argument('--stub_delay',type=float, default=0., help='artificial latency of the stub source in seconds')
+    parser.add_argument('--cache',type=str, help='SQLite file caching external lookups')
+    parser.add_argument('--cache_ttl',type=float, default=7*24*3600., help='seconds before a cached lookup expires')
+    parser.add_argument('--cache_size',type=int, default=100000, help='maximum number of cached lookups')
     args = parser.parse_args()
 
-    main(args.model, dictionary=args.dictionary,embeddings=args.embeddings)
+    main(args.model, dictionary=args.dictionary,embeddings=args.embeddings,
+         candidate_sources=args.sources.split(','), source_timeout=args.source_timeout,
+         stub_table=args.stub_table, stub_delay=args.stub_delay,
+         cache=args.cache, cache_ttl=args.cache_ttl, cache_size=args.cache_size)
@@ -1,5 +1,50 @@
 import cPickle as pkl
 import numpy
+import sys
+import os
+import threading
+import Queue
+
+from collections import OrderedDict
+
+
+class RaggedArray(object):
+    '''
+    List-like, read-only view of variable-length rows stored as one flat
+    array plus an offsets array (row i is data[offsets[i]:offsets[i+1]]),
+    optionally restricted to / reordered by the row ids in `index`.
+    '''
+    def __init__(self, data, offsets, index=None):
+        self.data = data
+        self.offsets = offsets
+        if index is None:
+            index = numpy.arange(offsets.shape[0] - 1)
+        self.index = index
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, ii):
+        jj = self.index[ii]
+        return self.data[self.offsets[jj]:self.offsets[jj+1]]
+
+    def __iter__(self):
+        for ii in xrange(len(self)):
+            yield self[ii]
+
+    @property
+    def starts(self):
+        return self.offsets[self.index]
+
+    @property
+    def lengths(self):
+        return self.offsets[self.index + 1] - self.offsets[self.index]
+
+# lengths of a list of sequences or of a RaggedArray, as an array
+def seq_lengths(seqs):
+    if isinstance(seqs, RaggedArray):
+        return seqs.lengths
+    return numpy.array([len(s) for s in seqs], dtype='int64')
 
 def prepare_data(seqs, contexts, maxlen=None):
     lengths = [len(s) for s in seqs]
@@ -29,7 +74,180 @@ def prepare_data(seqs, contexts, maxlen=None):
     return x, x_mask, contexts
 
 
+class BatchBuilder(object):
+    '''
+    Vectorized prepare_data for training loops. Builds x/x_mask for the
+    rows `index` of `seqs` (a RaggedArray or a list of sequences) in one
+    pass, drops rows with length >= maxlen with a boolean mask, and fills
+    preallocated buffers that are reused for every batch of the same
+    shape. Each shape keeps a ring of n_buffers buffers, so the last
+    n_buffers-1 batches stay valid while a new one is built.
+
+    x stays int64 and x_mask float32, as the compiled graphs expect.
+    '''
+    def __init__(self, n_buffers=2, max_shapes=256):
+        self.n_buffers = n_buffers
+        self.max_shapes = max_shapes
+        self._buffers = OrderedDict()
+
+    def _get(self, shape, ctx_shape, ctx_dtype):
+        key = (shape, ctx_shape)
+        if key in self._buffers:
+            ring = self._buffers.pop(key)
+        else:
+            ring = {'next': 0, 'bufs': []}
+            if len(self._buffers) >= self.max_shapes:
+                self._buffers.popitem(last=False)
+        self._buffers[key] = ring
+        if len(ring['bufs']) < self.n_buffers:
+            ring['bufs'].append((numpy.zeros(shape, dtype='int64'),
+                                 numpy.zeros(shape, dtype='float32'),
+                                 numpy.zeros(ctx_shape, dtype=ctx_dtype) if ctx_shape else None))
+        bufs = ring['bufs'][ring['next'] % len(ring['bufs'])]
+        ring['next'] += 1
+        return bufs
+
+    def __call__(self, seqs, contexts, index, maxlen=None):
+        index = numpy.asarray(index)
+        if isinstance(seqs, RaggedArray):
+            rows = seqs.index[index]
+            starts = seqs.offsets[rows]
+            lengths = seqs.offsets[rows + 1] - starts
+            data = seqs.data
+        else:
+            sel = [seqs[ii] for ii in index]
+            lengths = numpy.array([len(s) for s in sel], dtype='int64')
+            starts = numpy.concatenate([[0], numpy.cumsum(lengths)[:-1]]).astype('int64')
+            data = numpy.concatenate([numpy.asarray(s, dtype='int64') for s in sel] + [numpy.zeros((0,), dtype='int64')])
+
+        if maxlen is not None:
+            keep = lengths < maxlen
+            index, starts, lengths = index[keep], starts[keep], lengths[keep]
+        n_samples = lengths.shape[0]
+        if n_samples == 0:
+            return None, None, None
+
+        n_steps = lengths.max() + 1
+        if isinstance(contexts, numpy.ndarray):
+            x, x_mask, ctx = self._get((n_steps, n_samples), (n_samples,) + contexts.shape[1:], contexts.dtype)
+            numpy.take(contexts, index, axis=0, out=ctx)
+        else:
+            x, x_mask, _ = self._get((n_steps, n_samples), None, None)
+            ctx = [contexts[ii] for ii in index]
+
+        # scatter every token to (position in definition, column)
+        n_tokens = lengths.sum()
+        cols = numpy.repeat(numpy.arange(n_samples), lengths)
+        pos = numpy.arange(n_tokens) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        x.fill(0)
+        x[pos, cols] = data[numpy.repeat(starts, lengths) + pos]
+        numpy.less_equal(numpy.arange(n_steps)[:,None], lengths[None,:], out=x_mask, casting='unsafe')
+
+        return x, x_mask, ctx
+
+
+# iterate over (index, x, x_mask, ctx) for the given minibatches, building
+# up to n_prefetch of them ahead in a background thread; batches are passed
+# by reference, so build_batch needs at least n_prefetch+2 buffers per shape
+def prefetch_batches(build_batch, seqs, contexts, minibatches, maxlen=None, n_prefetch=2):
+    queue = Queue.Queue(maxsize=n_prefetch)
+    stop = threading.Event()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _worker():
+        try:
+            for _, index in minibatches:
+                if not _put((index,) + build_batch(seqs, contexts, index, maxlen=maxlen)):
+                    return
+            _put(None)
+        except Exception as e:
+            _put(e)
+
+    worker = threading.Thread(target=_worker, name='prefetch_batches')
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # also reached when the consumer stops early
+        stop.set()
+
+
+# columnar dataset with prefix P:
+#   P.tokens.npy   int32, all definitions concatenated
+#   P.offsets.npy  int64, #definitions+1 row boundaries into P.tokens.npy
+#   P.targets.npy  float32, #definitions x dim target embeddings
+def is_columnar(data_name):
+    return os.path.exists('%s.offsets.npy'%data_name)
+
+# convert a -da pickle (list of target arrays, list of index lists)
+def convert_to_columnar(data_name, prefix):
+    with open(data_name, 'rb') as f:
+        x = pkl.load(f)
+        y = pkl.load(f)
+    assert len(x) == len(y), 'targets and definitions are not aligned'
+
+    lengths = numpy.array([len(s) for s in y], dtype='int64')
+    offsets = numpy.concatenate([[0], numpy.cumsum(lengths)]).astype('int64')
+    numpy.save('%s.offsets.npy'%prefix, offsets)
+
+    tokens = numpy.lib.format.open_memmap('%s.tokens.npy'%prefix, mode='w+',
+                                          dtype='int32', shape=(offsets[-1],))
+    for ii, s in enumerate(y):
+        tokens[offsets[ii]:offsets[ii+1]] = s
+    tokens.flush()
+    del tokens
+
+    targets = numpy.lib.format.open_memmap('%s.targets.npy'%prefix, mode='w+',
+                                           dtype='float32', shape=(len(x), x[0].shape[0]))
+    for ii, v in enumerate(x):
+        targets[ii] = v
+    targets.flush()
+    del targets
+
+def load_columnar(data_name, n_words=20000, valid_portion=0.1):
+    offsets = numpy.load('%s.offsets.npy'%data_name)
+    tokens = numpy.load('%s.tokens.npy'%data_name, mmap_mode='r')
+    targets = numpy.load('%s.targets.npy'%data_name, mmap_mode='r')
+
+    # UNK remapping, only materialized if some index is out of vocabulary
+    if tokens.shape[0] > 0 and tokens.max() >= n_words:
+        tokens = numpy.where(tokens >= n_words, 1, tokens).astype('int32')
+
+    n_samples = offsets.shape[0] - 1
+    rndidx = numpy.random.permutation(n_samples)
+    n_valid = int(numpy.round(n_samples * valid_portion))
+
+    def normalize(v):
+        v = numpy.asarray(v, dtype='float32')
+        return v / numpy.sqrt((v ** 2).sum(axis=1))[:,None]
+
+    x_val = normalize(targets[numpy.sort(rndidx[-n_valid:])])
+    y_val = RaggedArray(tokens, offsets, numpy.sort(rndidx[-n_valid:]))
+
+    x = normalize(targets[numpy.sort(rndidx[:-n_valid])])
+    y = RaggedArray(tokens, offsets, numpy.sort(rndidx[:-n_valid]))
+
+    return (x,y), (x_val,y_val), None
+
 def load_data(data_name,n_words=20000, valid_portion=0.1):
+    if is_columnar(data_name):
+        return load_columnar(data_name, n_words=n_words, valid_portion=valid_portion)
+
     with open(data_name, 'rb') as f:
         x = pkl.load(f)
         y = pkl.load(f)
@@ -37,7 +255,7 @@ def load_data(data_name,n_words=20000, valid_portion=0.1):
     n_samples = len(x)
     rndidx = numpy.random.permutation(n_samples)
 
-    n_valid = numpy.round(n_samples * valid_portion)
+    n_valid = int(numpy.round(n_samples * valid_portion))
 
     def remove_unk(v):
         return [[1 if w >= n_words else w for w in sen] for sen in v]
@@ -53,3 +271,54 @@ def load_data(data_name,n_words=20000, valid_portion=0.1):
 
     return (x,y), (x_val,y_val), None
 
+
+# minibatches of definitions of similar length: sort by length (random
+# tie-breaking), cut into batches of batch_size definitions or, with a
+# token_budget, of at most token_budget padded tokens, and shuffle the
+# order of the batches
+def bucket_minibatches_idx(lengths, batch_size, token_budget=None, shuffle=True, rng=numpy.random):
+    lengths = numpy.asarray(lengths)
+    n = lengths.shape[0]
+    if shuffle:
+        order = numpy.lexsort((rng.rand(n), lengths))
+    else:
+        order = numpy.argsort(lengths, kind='mergesort')
+    # +1 for the <eos> step that prepare_data adds
+    padded = lengths[order] + 1
+
+    minibatches = []
+    if token_budget:
+        start = 0
+        while start < n:
+            window = padded[start:start+token_budget]
+            # padded size of the batch order[start:start+j+1], nondecreasing in j
+            costs = numpy.arange(1, window.shape[0]+1) * window
+            size = max(1, numpy.searchsorted(costs, token_budget, side='right'))
+            minibatches.append(order[start:start+size])
+            start += size
+    else:
+        for start in xrange(0, n, batch_size):
+            minibatches.append(order[start:start+batch_size])
+
+    if shuffle:
+        rng.shuffle(minibatches)
+
+    return zip(range(len(minibatches)), minibatches)
+
+# fraction of the padded x/mask entries that hold real tokens (or <eos>)
+def padding_efficiency(lengths, minibatches):
+    lengths = numpy.asarray(lengths)
+    real = 0
+    padded = 0
+    for _, idx in minibatches:
+        l = lengths[idx] + 1
+        real += l.sum()
+        padded += l.max() * l.shape[0]
+    return float(real) / max(padded, 1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print 'usage: python load_prepare_data.py data.pkl output_prefix'
+    else:
+        convert_to_columnar(sys.argv[1], sys.argv[2])
@@ -0,0 +1,122 @@
+'''
+Caches for reverse-dictionary lookups: a persistent (SQLite) cache for
+external sources and an in-process LRU cache for encoded descriptions
+'''
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+
+
+# case- and whitespace-insensitive cache key
+def normalize_query(query):
+    if isinstance(query, str):
+        query = query.decode('utf-8', 'replace')
+    return u' '.join(query.lower().split())
+
+
+class LookupCache(object):
+    '''
+    On-disk {normalized query: candidate list} cache with a time-to-live
+    (ttl, in seconds; None = never expires) and at most max_entries rows,
+    evicting expired rows, then the least recently used ones, once it
+    grows evict_margin past that. The file can be shared by several
+    processes; the row count is only re-read when evicting.
+    '''
+    def __init__(self, path, ttl=7*24*3600., max_entries=100000, evict_margin=0.1):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_margin = max(1, int(max_entries * evict_margin))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30., check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS lookups '
+                         '(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS lookups_accessed ON lookups (accessed)')
+        self._db.commit()
+        self._n_rows = self._count()
+
+    def _count(self):
+        return self._db.execute('SELECT COUNT(*) FROM lookups').fetchone()[0]
+
+    def get(self, key):
+        key = normalize_query(key)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT value, created FROM lookups WHERE key = ?', (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE lookups SET accessed = ? WHERE key = ?', (now, key))
+            self._db.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        key = normalize_query(key)
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?, ?)',
+                             (key, json.dumps(value), now, now))
+            # counts replaced keys too, so eviction may come a little early
+            self._n_rows += 1
+            if self._n_rows > self.max_entries + self.evict_margin:
+                self._evict(now)
+            self._db.commit()
+
+    # drop expired rows, then the least recently used down to max_entries
+    def _evict(self, now):
+        if self.ttl is not None:
+            self._db.execute('DELETE FROM lookups WHERE created < ?', (now - self.ttl,))
+        n_rows = self._count()
+        if n_rows > self.max_entries:
+            self._db.execute('DELETE FROM lookups WHERE key IN '
+                             '(SELECT key FROM lookups ORDER BY accessed LIMIT ?)',
+                             (n_rows - self.max_entries,))
+            n_rows = self.max_entries
+        self._n_rows = n_rows
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class QueryCache(object):
+    '''
+    Bounded in-process LRU cache mapping a description's token-id sequence
+    to its encoder output and to its top-k lists. Entries are keyed on a
+    fingerprint of the model and embeddings they were computed with, so
+    they never answer for a different model.
+    '''
+    def __init__(self, max_entries=10000, fingerprint=None):
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        key = (self.fingerprint, key)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        key = (self.fingerprint, key)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
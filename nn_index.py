@@ -0,0 +1,199 @@
+'''
+Nearest-neighbour index over (normalized) word vectors
+'''
+import cPickle as pkl
+import hashlib
+import numpy
+
+
+# top-k of the columns of a (#candidates x #queries) score matrix
+def _topk(scores, k):
+    k = min(k, scores.shape[0])
+    if k < scores.shape[0]:
+        part = numpy.argpartition(-scores, k-1, axis=0)[:k]
+    else:
+        part = numpy.tile(numpy.arange(scores.shape[0])[:,None], [1, scores.shape[1]])
+    part_scores = scores[part, numpy.arange(scores.shape[1])[None,:]]
+    order = numpy.argsort(-part_scores, axis=0)
+    cols = numpy.arange(scores.shape[1])[None,:]
+    return part[order, cols], part_scores[order, cols]
+
+# numpy.savez appends .npz to names without it; use the same name to load
+def index_path(path):
+    if not path.endswith('.npz'):
+        path = '%s.npz'%path
+    return path
+
+# cheap identity of the indexed vectors: shape, words and a sample of rows
+def vectors_fingerprint(vectors, words=None, n_sample=1000):
+    h = hashlib.md5()
+    h.update(repr(vectors.shape))
+    if words is not None:
+        for ww in words:
+            h.update(ww.encode('utf-8') if isinstance(ww, unicode) else ww)
+            h.update('\n')
+    step = max(1, vectors.shape[0] / n_sample)
+    h.update(numpy.ascontiguousarray(vectors[::step], dtype='float32').tostring())
+    return h.hexdigest()
+
+# spherical k-means, used as the coarse quantizer of the IVF index
+def _kmeans(vectors, n_lists, n_iter=10, n_train=100000, seed=1234):
+    rng = numpy.random.RandomState(seed)
+    if vectors.shape[0] > n_train:
+        vectors = vectors[rng.choice(vectors.shape[0], n_train, replace=False)]
+    centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)].copy()
+    for ii in xrange(n_iter):
+        assign = vectors.dot(centroids.T).argmax(1)
+        for cc in xrange(n_lists):
+            members = vectors[assign == cc]
+            if members.shape[0] > 0:
+                centroids[cc] = members.sum(0)
+        centroids /= numpy.sqrt((centroids ** 2).sum(1))[:,None] + 1e-8
+    return centroids
+
+
+class NNIndex(object):
+    '''
+    Inner-product top-k index over a matrix of row vectors.
+
+    mode='exact' scores every vector with a blocked matrix product and keeps
+    the top k of each block with argpartition. mode='ivf' clusters the vectors
+    into n_lists inverted lists and only scores the nprobe lists closest to the
+    query (higher nprobe = better recall, slower queries).
+    '''
+    def __init__(self, vectors, words=None, mode='exact', n_lists=None,
+                 nprobe=8, block_size=65536):
+        assert mode in ('exact', 'ivf'), 'Unknown index mode %s'%mode
+        self.mode = mode
+        self.nprobe = nprobe
+        self.block_size = block_size
+        self._vectors = numpy.asarray(vectors, dtype='float32')
+        self.n = self._vectors.shape[0]
+        self.words = list(words) if words is not None else None
+        if mode == 'ivf':
+            if n_lists is None:
+                n_lists = max(1, int(numpy.sqrt(self.n)))
+            self.centroids = _kmeans(self._vectors[:self.n], n_lists)
+            self._build_lists(self._assign(self._vectors[:self.n]))
+
+    @property
+    def vectors(self):
+        return self._vectors[:self.n]
+
+    def __len__(self):
+        return self.n
+
+    def _assign(self, vectors):
+        assign = numpy.zeros((vectors.shape[0],), dtype='int64')
+        for b0 in xrange(0, vectors.shape[0], self.block_size):
+            assign[b0:b0+self.block_size] = vectors[b0:b0+self.block_size].dot(self.centroids.T).argmax(1)
+        return assign
+
+    def _build_lists(self, assign):
+        order = numpy.argsort(assign, kind='mergesort')
+        bounds = numpy.searchsorted(assign[order], numpy.arange(self.centroids.shape[0]+1))
+        self.lists = [order[bounds[cc]:bounds[cc+1]] for cc in xrange(self.centroids.shape[0])]
+
+    def add(self, vectors, words=None):
+        '''Append new vectors (and words) without rebuilding the index.'''
+        vectors = numpy.asarray(vectors, dtype='float32').reshape([-1, self._vectors.shape[1]])
+        n_new = vectors.shape[0]
+        # grow geometrically so that repeated adds stay amortized O(1) per row
+        if self.n + n_new > self._vectors.shape[0]:
+            capacity = max(self.n + n_new, 2 * self._vectors.shape[0])
+            grown = numpy.zeros((capacity, self._vectors.shape[1]), dtype='float32')
+            grown[:self.n] = self._vectors[:self.n]
+            self._vectors = grown
+        self._vectors[self.n:self.n+n_new] = vectors
+        new_ids = numpy.arange(self.n, self.n + n_new)
+        self.n += n_new
+        if self.words is not None:
+            assert words is not None and len(words) == n_new, 'words must be given for each new vector'
+            self.words.extend(words)
+        if self.mode == 'ivf':
+            assign = self._assign(vectors)
+            for cc in numpy.unique(assign):
+                self.lists[cc] = numpy.concatenate([self.lists[cc], new_ids[assign == cc]])
+        return new_ids
+
+    def search(self, queries, k=10):
+        '''Return (#queries x k) arrays of row ids and scores, best first.'''
+        queries = numpy.asarray(queries, dtype='float32')
+        if queries.ndim == 1:
+            queries = queries[None,:]
+        if self.mode == 'exact':
+            return self._search_exact(queries, k)
+        return self._search_ivf(queries, k)
+
+    def _search_exact(self, queries, k):
+        cand_ids = []
+        cand_scores = []
+        for b0 in xrange(0, self.n, self.block_size):
+            b1 = min(b0 + self.block_size, self.n)
+            ids, scores = _topk(self._vectors[b0:b1].dot(queries.T), k)
+            cand_ids.append(ids + b0)
+            cand_scores.append(scores)
+        cand_ids = numpy.concatenate(cand_ids, axis=0)
+        cand_scores = numpy.concatenate(cand_scores, axis=0)
+        pos, scores = _topk(cand_scores, k)
+        ids = cand_ids[pos, numpy.arange(queries.shape[0])[None,:]]
+        return ids.T, scores.T
+
+    def _search_ivf(self, queries, k):
+        nprobe = min(self.nprobe, self.centroids.shape[0])
+        probes, _ = _topk(self.centroids.dot(queries.T), nprobe)
+        ids = numpy.zeros((queries.shape[0], k), dtype='int64') - 1
+        scores = numpy.zeros((queries.shape[0], k), dtype='float32') - numpy.inf
+        for qq in xrange(queries.shape[0]):
+            cand = numpy.concatenate([self.lists[cc] for cc in probes[:,qq]])
+            if cand.shape[0] == 0:
+                continue
+            pos, sc = _topk(self._vectors[cand].dot(queries[qq])[:,None], k)
+            ids[qq,:pos.shape[0]] = cand[pos[:,0]]
+            scores[qq,:pos.shape[0]] = sc[:,0]
+        return ids, scores
+
+    def save(self, path):
+        '''
+        Save the index structures (not the vectors, which are taken from the
+        embeddings again by load) to `path`(.npz) and `path`(.npz).pkl.
+        '''
+        path = index_path(path)
+        arrays = {'shape': numpy.array(self.vectors.shape, dtype='int64')}
+        if self.mode == 'ivf':
+            arrays['centroids'] = self.centroids
+            arrays['list_sizes'] = numpy.array([len(ll) for ll in self.lists], dtype='int64')
+            arrays['list_ids'] = numpy.concatenate(self.lists).astype('int64')
+        numpy.savez(path, **arrays)
+        with open('%s.pkl'%path, 'wb') as f:
+            pkl.dump({'mode': self.mode, 'nprobe': self.nprobe,
+                      'block_size': self.block_size,
+                      'fingerprint': vectors_fingerprint(self.vectors, self.words)}, f)
+
+    @classmethod
+    def load(cls, path, vectors, words=None):
+        '''
+        Load a saved index over `vectors` (and `words`), e.g. the memory-mapped
+        matrix of an EmbeddingStore, which is used without copying. Raises
+        ValueError if the index was saved for different vectors.
+        '''
+        path = index_path(path)
+        with open('%s.pkl'%path, 'rb') as f:
+            meta = pkl.load(f)
+        pp = numpy.load(path)
+        vectors = numpy.asarray(vectors, dtype='float32')
+        if (tuple(pp['shape']) != vectors.shape or 
+                meta['fingerprint'] != vectors_fingerprint(vectors, words)):
+            raise ValueError('Index %s does not match the given vectors'%path)
+        index = cls.__new__(cls)
+        index.mode = meta['mode']
+        index.nprobe = meta['nprobe']
+        index.block_size = meta['block_size']
+        index.words = list(words) if words is not None else None
+        index._vectors = vectors
+        index.n = index._vectors.shape[0]
+        if index.mode == 'ivf':
+            index.centroids = pp['centroids']
+            bounds = numpy.concatenate([[0], numpy.cumsum(pp['list_sizes'])])
+            index.lists = [pp['list_ids'][bounds[cc]:bounds[cc+1]] for cc in xrange(len(bounds)-1)]
+        return index
@@ -0,0 +1,63 @@
+'''
+Pure-NumPy forward pass of the defgen_rev encoder (no Theano needed)
+
+Mirrors defgen_rev.build_fprop: word embedding -> lstm_layer -> masked
+mean-pool over time -> linear ff_out, loading the same .npz/.pkl files.
+'''
+import cPickle as pkl
+import numpy
+
+
+def _p(pp, name):
+    return '%s_%s'%(pp, name)
+
+def _sigmoid(x):
+    return 1. / (1. + numpy.exp(-x))
+
+# load model options and the parameters the encoder needs
+def load_model(path):
+    with open('%s.pkl'%path, 'rb') as f:
+        options = pkl.load(f)
+    pp = numpy.load(path)
+    params = dict()
+    for kk in ['Wemb', 'encoder_W', 'encoder_U', 'encoder_b', 'ff_out_W', 'ff_out_b']:
+        if kk not in pp:
+            raise Warning('%s is not in the archive'%kk)
+        params[kk] = pp[kk].astype('float32')
+    return options, params
+
+def lstm_layer(params, state_below, mask, prefix='encoder'):
+    nsteps, n_samples = state_below.shape[0], state_below.shape[1]
+    U = params[_p(prefix, 'U')]
+    dim = U.shape[0]
+
+    state_below = state_below.dot(params[_p(prefix, 'W')]) + params[_p(prefix, 'b')]
+
+    h = numpy.zeros((n_samples, dim), dtype='float32')
+    c = numpy.zeros((n_samples, dim), dtype='float32')
+    hs = numpy.zeros((nsteps, n_samples, dim), dtype='float32')
+    for t in xrange(nsteps):
+        preact = h.dot(U) + state_below[t] + params[_p(prefix, 'b')]
+        i = _sigmoid(preact[:, :dim])
+        f = _sigmoid(preact[:, dim:2*dim])
+        o = _sigmoid(preact[:, 2*dim:3*dim])
+        c_ = f * c + i * preact[:, 3*dim:]
+        m_ = mask[t][:,None]
+        c = m_ * c_ + (1. - m_) * c
+        h_ = o * numpy.tanh(c)
+        h = m_ * h_ + (1. - m_) * h
+        hs[t] = h
+    return hs
+
+def fprop(params, options, x, mask):
+    emb = params['Wemb'][x.flatten()].reshape([x.shape[0], x.shape[1], options['dim_word']])
+    proj_h = lstm_layer(params, emb, mask, prefix='encoder')
+    proj_h = (proj_h * mask[:,:,None]).sum(axis=0)
+    proj_h = proj_h / mask.sum(axis=0)[:,None]
+    return proj_h.dot(params['ff_out_W']) + params['ff_out_b']
+
+# drop-in replacement for the compiled f_prop returned by build_fprop
+def build_numpy_fprop(params, options):
+    def f_prop(x, mask):
+        return fprop(params, options, x, mask.astype('float32'))
+    return f_prop
@@ -0,0 +1,45 @@
+'''
+Positional letter index for crossword-style pattern lookup (e.g. ??e??a?)
+'''
+import numpy
+
+
+class PatternIndex(object):
+    '''
+    Word ids partitioned by length, with a sorted posting list of ids for
+    every (length, position, letter). A pattern resolves to the
+    intersection of the posting lists of its known letters.
+    '''
+    def __init__(self, words, unknown='?'):
+        self.unknown = unknown
+        by_length = {}
+        postings = {}
+        for ii, ww in enumerate(words):
+            by_length.setdefault(len(ww), []).append(ii)
+            for pos, ch in enumerate(ww):
+                postings.setdefault((len(ww), pos, ch), []).append(ii)
+        # ids are appended in increasing order, so every list is sorted
+        self.by_length = dict((kk, numpy.array(vv, dtype='int64')) for kk, vv in by_length.iteritems())
+        self.postings = dict((kk, numpy.array(vv, dtype='int64')) for kk, vv in postings.iteritems())
+
+    def lookup(self, form):
+        '''Sorted ids of the words of length len(form) matching its known letters.'''
+        length = len(form)
+        empty = numpy.zeros((0,), dtype='int64')
+        lists = []
+        for pos, ch in enumerate(form):
+            if ch == self.unknown:
+                continue
+            if (length, pos, ch) not in self.postings:
+                return empty
+            lists.append(self.postings[(length, pos, ch)])
+        if not lists:
+            return self.by_length.get(length, empty)
+        # intersect the shortest lists first
+        lists.sort(key=len)
+        ids = lists[0]
+        for ll in lists[1:]:
+            ids = numpy.intersect1d(ids, ll, assume_unique=True)
+            if ids.shape[0] == 0:
+                break
+        return ids
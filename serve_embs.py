@@ -0,0 +1,202 @@
+'''
+Serve the reverse dictionary over HTTP, micro-batching concurrent queries
+
+GET  /?q=a+small+dog&k=10
+POST / {"query": "a small dog", "k": 10}
+'''
+import argparse
+import json
+import sys
+import threading
+import time
+import urlparse
+import Queue
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import cPickle as pkl
+
+from embedding_store import load_embeddings
+from generate_embs import load_encoder, load_index, rank, fingerprint
+from lookup_cache import QueryCache
+
+
+class MicroBatcher(object):
+    '''
+    Collects queries from concurrent callers and answers them in batches.
+
+    A batch is closed when it holds max_batch queries or when the oldest
+    query in it has waited max_wait seconds, whichever comes first.
+    '''
+    def __init__(self, f_prop, worddict, nn, max_batch=64, max_wait=0.005, cache=None):
+        self.f_prop = f_prop
+        self.cache = cache
+        self.worddict = worddict
+        self.nn = nn
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        self.worker = threading.Thread(target=self._loop, name='micro_batcher')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def query(self, description, k=10):
+        item = {'query': description, 'k': k, 'done': threading.Event()}
+        self.queue.put(item)
+        item['done'].wait()
+        if 'error' in item:
+            raise item['error']
+        return item['result']
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                k = max(item['k'] for item in batch)
+                ranked = rank(self.f_prop, self.worddict, self.nn, 
+                              [item['query'] for item in batch], k, self.cache)
+                for item, (ii, ss) in zip(batch, ranked):
+                    item['result'] = [[self.nn.words[w], float(sc)]
+                                      for w, sc in zip(ii[:item['k']], ss[:item['k']])]
+            except Exception as e:
+                for item in batch:
+                    item['error'] = e
+            for item in batch:
+                item['done'].set()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher, default_k=10):
+    class Handler(BaseHTTPRequestHandler):
+        def _answer(self, description, k):
+            if not description or not description.strip():
+                self.send_error(400, 'empty query')
+                return
+            try:
+                result = batcher.query(description.strip(), k)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            body = json.dumps({'query': description.strip(), 'candidates': result})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # parse() returns the (query, k) of a request; bad parameters
+        # (k that is not a positive integer, e.g. 2.7 or true, a query that
+        # is not a string, a JSON body that is not an object) get a 400 answer
+        def _answer_request(self, parse):
+            try:
+                description, k = parse()
+                n = int(k)
+                if isinstance(k, bool) or float(k) != n:
+                    raise ValueError('k must be an integer')
+                if not isinstance(description, basestring):
+                    raise TypeError('query must be a string')
+            except (ValueError, TypeError, AttributeError, OverflowError) as e:
+                self.send_error(400, 'bad request: %s'%e)
+                return
+            if n < 1:
+                self.send_error(400, 'k must be at least 1')
+                return
+            self._answer(description, n)
+
+        def do_GET(self):
+            qs = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+            self._answer_request(lambda: (qs.get('q', [''])[0], qs.get('k', [default_k])[0]))
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.getheader('content-length', 0))
+                req = json.loads(self.rfile.read(length))
+            except ValueError:
+                self.send_error(400, 'malformed JSON')
+                return
+            self._answer_request(lambda: (req.get('query', ''), req.get('k', default_k)))
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main(model,
+         dictionary,
+         embeddings,
+         index=None,
+         index_mode='exact',
+         nprobe=8,
+         host='127.0.0.1',
+         port=8000,
+         max_batch=64,
+         max_wait=0.005,
+         k=10,
+         query_cache_size=10000,
+         engine='theano'):
+
+    with open(dictionary, 'rb') as f:
+        worddict = pkl.load(f)
+
+    print 'Loading skipgram vectors...',
+    wv = load_embeddings(embeddings)
+    print 'Done'
+
+    print 'Loading index...',
+    nn = load_index(wv, index, index_mode, nprobe)
+    print 'Done'
+
+    model_options, f_prop = load_encoder(model, engine)
+
+    query_cache = None
+    if query_cache_size > 0:
+        query_cache = QueryCache(query_cache_size, fingerprint(model, embeddings, index))
+
+    batcher = MicroBatcher(f_prop, worddict, nn, max_batch=max_batch, max_wait=max_wait,
+                           cache=query_cache)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, default_k=k))
+    print 'Serving on %s:%d'%(host, port)
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m','--model', type=str)
+    parser.add_argument('-e','--embeddings',type=str, help='embedding pickle or memory-mapped store prefix')
+    parser.add_argument('-dic','--dictionary',type=str)
+    parser.add_argument('-i','--index',type=str, help='nearest-neighbour index file (built and saved if missing)')
+    parser.add_argument('--index_mode',type=str, default='exact', help='exact or ivf')
+    parser.add_argument('--nprobe',type=int, default=8, help='number of lists probed by the ivf index')
+    parser.add_argument('--engine',type=str, default='theano', help='encoder implementation: theano or numpy')
+    parser.add_argument('--host',type=str, default='127.0.0.1')
+    parser.add_argument('-p','--port',type=int, default=8000)
+    parser.add_argument('--max_batch',type=int, default=64, help='maximum number of queries encoded together')
+    parser.add_argument('--max_wait',type=float, default=0.005, help='maximum seconds a query waits for its batch to fill')
+    parser.add_argument('-k','--topk',type=int, default=10, help='default number of candidates per query')
+    parser.add_argument('--query_cache_size',type=int, default=10000, help='in-process LRU entries for encoded descriptions (0 disables)')
+    args = parser.parse_args()
+
+    main(args.model, dictionary=args.dictionary, embeddings=args.embeddings,
+         index=args.index, index_mode=args.index_mode, nprobe=args.nprobe,
+         host=args.host, port=args.port, max_batch=args.max_batch,
+         max_wait=args.max_wait, k=args.topk, query_cache_size=args.query_cache_size,
+         engine=args.engine)